@@ -0,0 +1,99 @@
+"""
+Сборка статики: копии файлов из static/ с хэшем содержимого в имени
+(css/style.css -> css/style.3f2a9c1d.css) и сжатые заранее версии текстовых
+файлов (.gz, и .br, если установлен brotli) в STATIC_BUILD_PATH.
+
+Такие файлы не меняются никогда, поэтому отдаются с Cache-Control immutable,
+и браузер не перепроверяет их при каждом переходе; каталог сборки можно отдать
+и nginx/CDN мимо воркеров gunicorn. Сборка запускается при старте приложения
+или заранее:
+
+    python -m assets
+"""
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+import sys
+
+import simplejson
+
+from settings import STATIC_PATH, STATIC_BUILD_PATH
+
+# без brotli сжатые копии делаются только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSED_TYPES = ('.css', '.js', '.svg', '.html', '.txt', '.json')
+MANIFEST = 'manifest.json'
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def fingerprinted(name, content):
+    base, extension = posixpath.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha256(content).hexdigest()[:12], extension)
+
+
+def write(path, content, overwrite=False):
+    # несколько воркеров могут собирать одновременно: файл появляется на месте только целиком
+    if os.path.exists(path) and not overwrite:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def compress(path, content):
+    variants = [('.gz', gzip.compress(content, 9))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            write(path + suffix, compressed)
+
+
+def rewrite_css(name, content, manifest):
+    """Ссылки url(...) в css на другие файлы статики заменяются на их копии с хэшем"""
+    directory = posixpath.dirname(name)
+
+    def replace(match):
+        quote, url = match.groups()
+        target = posixpath.normpath(posixpath.join(directory, url))
+        if target not in manifest:
+            return match.group(0)
+        return 'url(%s%s%s)' % (quote, posixpath.relpath(manifest[target], directory), quote)
+
+    return CSS_URL.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def build(source=STATIC_PATH, target=STATIC_BUILD_PATH):
+    """Собирает статику и возвращает манифест: {имя в static/: имя копии с хэшем}"""
+    names = sorted(posixpath.relpath(os.path.join(path, name), source).replace(os.sep, '/')
+                   for path, _, files in os.walk(source) for name in files)
+    manifest = dict()
+    # css ссылаются на картинки, поэтому собираются после них
+    for name in sorted(names, key=lambda name: name.endswith('.css')):
+        with open(os.path.join(source, name), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = rewrite_css(name, content, manifest)
+        manifest[name] = fingerprinted(name, content)
+        path = os.path.join(target, manifest[name])
+        write(path, content)
+        if name.endswith(COMPRESSED_TYPES):
+            compress(path, content)
+
+    # манифест - для тех, кто отдаёт сборку мимо приложения
+    write(os.path.join(target, MANIFEST), simplejson.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'),
+          overwrite=True)
+    return manifest
+
+
+if __name__ == '__main__':
+    manifest = build()
+    print('%d files built into %s' % (len(manifest), STATIC_BUILD_PATH), file=sys.stderr)
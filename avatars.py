@@ -0,0 +1,127 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from PIL import Image
+
+from settings import AVATARS_PATH, AVATAR_MAX_SIZE, AVATAR_THUMBNAIL_SIZE
+
+CHUNK_SIZE = 64 * 1024
+# форматы, которые принимаются как фото: формат Pillow -> расширение и тип для браузера;
+# расширение берётся из содержимого файла, а не из имени, которое прислал браузер
+IMAGE_FORMATS = {
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'PNG': ('.png', 'image/png'),
+    'GIF': ('.gif', 'image/gif'),
+}
+MIMETYPES = dict(IMAGE_FORMATS.values())
+STORED_NAME = re.compile(r'^[0-9a-f]{64}(_thumb)?(\.jpg|\.png|\.gif)$')
+
+
+class AvatarTooLarge(ValueError):
+    pass
+
+
+class NotAnImage(ValueError):
+    pass
+
+
+def is_stored(name):
+    """Лежит ли фото в AVATARS_PATH (а не в static/img/<телефон>/, как у старых профилей)"""
+    return name is not None and STORED_NAME.match(name) is not None
+
+
+def path(name):
+    # раскладываем по подкаталогам из первых двух символов хэша, чтобы не держать всё в одном
+    return os.path.join(AVATARS_PATH, name[:2], name)
+
+
+def receive(file_storage):
+    """
+    Копирует загруженное фото во временный файл и возвращает (имя, путь к временному файлу),
+    где имя - из sha256 содержимого. На место фото ставит store(), а discard() удаляет
+    временный файл, если фото так и не понадобилось.
+
+    Файл копируется на диск частями, без чтения целиком в память; если он больше
+    AVATAR_MAX_SIZE, копирование прерывается с AvatarTooLarge, а если это не картинка
+    одного из IMAGE_FORMATS - с NotAnImage.
+    """
+    os.makedirs(AVATARS_PATH, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=AVATARS_PATH, prefix='.upload-', delete=False) as tmp:
+        try:
+            for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > AVATAR_MAX_SIZE:
+                    raise AvatarTooLarge(size)
+                digest.update(chunk)
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+
+    try:
+        extension = image_extension(tmp.name)
+    except NotAnImage:
+        os.unlink(tmp.name)
+        raise
+    return digest.hexdigest() + extension, tmp.name
+
+
+def image_extension(file_path):
+    try:
+        with Image.open(file_path) as image:
+            image_format = image.format
+            # картинка декодируется целиком: verify() не замечает, например, обрезанный JPEG;
+            # от слишком больших по числу пикселей защищает Image.MAX_IMAGE_PIXELS
+            image.load()
+    except Exception:
+        # Pillow сообщает о битых и неизвестных файлах разными исключениями
+        raise NotAnImage()
+    if image_format not in IMAGE_FORMATS:
+        raise NotAnImage()
+    return IMAGE_FORMATS[image_format][0]
+
+
+def store(name, tmp_path):
+    # одинаковые фото хранятся в одном экземпляре
+    if os.path.exists(path(name)):
+        discard(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path(name)), exist_ok=True)
+        os.replace(tmp_path, path(name))
+        make_thumbnail(name)
+
+
+def discard(tmp_path):
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+
+
+def thumbnail_name(name):
+    return name.split('.')[0] + '_thumb.jpg'
+
+
+def make_thumbnail(name):
+    try:
+        with Image.open(path(name)) as image:
+            image.thumbnail(AVATAR_THUMBNAIL_SIZE)
+            tmp = path(thumbnail_name(name)) + '.tmp'
+            image.convert('RGB').save(tmp, 'JPEG', quality=85, optimize=True)
+        os.replace(tmp, path(thumbnail_name(name)))
+    except (IOError, OSError, ValueError):
+        # Pillow проверил файл, но не смог его уменьшить - страницы покажут оригинал
+        pass
+
+
+def displayed_name(name):
+    """Имя файла, который показывать на страницах: миниатюра, если она есть"""
+    thumbnail = thumbnail_name(name)
+    return thumbnail if os.path.exists(path(thumbnail)) else name
+
+
+def mimetype(name):
+    return MIMETYPES[os.path.splitext(name)[1]]
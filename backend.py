@@ -0,0 +1,323 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from cache import TTLCache
+from settings import SERVICES_URI, BACKEND_POOL_CONNECTIONS, BACKEND_POOL_MAXSIZE, \
+    BACKEND_FANOUT_WORKERS, BACKEND_FANOUT_TIMEOUT, BACKEND_TIMEOUTS, BACKEND_DEFAULT_TIMEOUT, \
+    BACKEND_GET_RETRIES, BACKEND_RETRY_BUDGET, BACKEND_BREAKER_THRESHOLD, BACKEND_BREAKER_COOLDOWN, \
+    BACKEND_COALESCE_GETS, BACKEND_COALESCE_TTL, BACKEND_REQUEST_DEADLINE
+
+# ответы, после которых сервис считается сбойным, а GET можно повторить
+RETRYABLE_STATUSES = {502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Сервис недавно много раз подряд не отвечал, запрос к нему даже не отправлялся"""
+
+
+class CircuitBreaker:
+    """
+    После threshold сбоев подряд размыкается, и запросы к сервису сразу завершаются
+    CircuitOpenError. Через cooldown секунд пропускает один пробный запрос:
+    если он успешен, цепь замыкается, если нет - размыкается ещё на cooldown.
+    """
+
+    def __init__(self, threshold=BACKEND_BREAKER_THRESHOLD, cooldown=BACKEND_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_request(self, name):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError('service %s is unavailable' % name)
+            self.probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class RetryBudget:
+    """
+    Ограничивает повторы долей ratio от числа запросов: каждый запрос добавляет
+    ratio жетона, каждый повтор тратит один. Так при отказе сервиса повторы
+    не умножают нагрузку на него.
+    """
+
+    def __init__(self, ratio=BACKEND_RETRY_BUDGET, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые одновременные запросы: пока первый из них выполняется,
+    остальные ждут его и получают тот же результат. Если задан result_ttl, результат
+    ещё столько секунд отдаётся следующим таким же запросам без обращения к сервису.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, result_ttl=0, results_size=1000):
+        self.results = TTLCache(maxsize=results_size, ttl=result_ttl) if result_ttl > 0 else None
+        self.coalesced = 0
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            if self.results is not None:
+                result = self.results.get(key)
+                if result is not None:
+                    self.coalesced += 1
+                    return result
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if self.results is not None and call.error is None:
+                    self.results.set(key, call.result)
+            call.done.set()
+
+    def forget(self):
+        if self.results is not None:
+            self.results.invalidate()
+
+
+def _clamp_timeout(timeout, deadline):
+    # таймауты (на соединение, на чтение) не дольше, чем осталось до дедлайна
+    remaining = max(deadline - time.monotonic(), 0.001)
+    if isinstance(timeout, tuple):
+        return tuple(min(part, remaining) for part in timeout)
+    return min(timeout, remaining)
+
+
+class ServiceClient:
+    """
+    Клиент одного сервиса из SERVICES_URI.
+
+    Пул keep-alive соединений (HTTPAdapter) общий для всех потоков воркера,
+    а requests.Session у каждого потока своя: сам пул потокобезопасен,
+    а состояние Session (cookies, заголовки) - нет.
+
+    У каждого запроса есть таймауты на соединение и чтение (BACKEND_TIMEOUTS),
+    а все его попытки вместе ограничены BACKEND_REQUEST_DEADLINE.
+    Идемпотентные GET при ошибках соединения и ответах из RETRYABLE_STATUSES
+    повторяются не более BACKEND_GET_RETRIES раз в пределах RetryBudget,
+    а при систематических сбоях сервис отключается CircuitBreaker.
+
+    Одинаковые одновременные GET (тот же адрес и те же параметры) объединяются
+    SingleFlight в один запрос к сервису. Ответ общий, но json() каждый раз
+    разбирает его заново, поэтому полученные данные можно менять.
+    """
+
+    def __init__(self, name, base_uri, pool_connections=BACKEND_POOL_CONNECTIONS, pool_maxsize=BACKEND_POOL_MAXSIZE):
+        self.name = name
+        self.base_uri = base_uri
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self._local = threading.local()
+
+        self.timeout = BACKEND_TIMEOUTS.get(name, BACKEND_DEFAULT_TIMEOUT)
+        self.breaker = CircuitBreaker()
+        self.retry_budget = RetryBudget()
+        self.singleflight = SingleFlight(BACKEND_COALESCE_TTL) if BACKEND_COALESCE_GETS else None
+
+    @property
+    def http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = requests.Session()
+            # сессия потока обслуживает запросы разных пользователей: cookie от сервиса,
+            # полученная для одного, не должна уходить с запросами для другого
+            http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            http.mount('http://', self.adapter)
+            http.mount('https://', self.adapter)
+            self._local.http = http
+        return http
+
+    def url(self, *parts):
+        return '/'.join([self.base_uri] + [str(part) for part in parts])
+
+    def request(self, method, *parts, **kwargs):
+        started_at = time.perf_counter()
+        error = True
+        try:
+            if method == 'GET' and self.singleflight is not None:
+                key = (self.url(*parts), tuple(sorted((kwargs.get('params') or {}).items())))
+                response = self.singleflight.do(key, lambda: self._request(method, *parts, **kwargs))
+            else:
+                response = self._request(method, *parts, **kwargs)
+                if self.singleflight is not None:
+                    # после изменений сохранённые результаты GET уже могут быть неверны
+                    self.singleflight.forget()
+            error = response.status_code >= 500
+            return response
+        finally:
+            metrics.observe_backend(self.name, method, time.perf_counter() - started_at, error)
+
+    def _request(self, method, *parts, **kwargs):
+        timeout = kwargs.pop('timeout', self.timeout)
+        url = self.url(*parts)
+        retries = BACKEND_GET_RETRIES if method == 'GET' else 0
+        # все попытки вместе укладываются в BACKEND_REQUEST_DEADLINE
+        deadline = time.monotonic() + BACKEND_REQUEST_DEADLINE
+        self.retry_budget.deposit()
+
+        while True:
+            self.breaker.before_request(self.name)
+            try:
+                response = self.http.request(method, url, timeout=_clamp_timeout(timeout, deadline), **kwargs)
+            except requests.exceptions.ReadTimeout:
+                # сервис принял запрос и не успел ответить: повтор скорее всего так же
+                # долго будет ждать и съест время, которого у запроса пользователя уже нет
+                self.breaker.record_failure()
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.breaker.record_failure()
+                if self._may_retry(retries, deadline):
+                    retries -= 1
+                    continue
+                raise
+            except BaseException:
+                # любая другая ошибка (ChunkedEncodingError, TooManyRedirects, gevent.Timeout...)
+                # тоже сбой: иначе пробный запрос так и не завершился бы, и цепь осталась бы разомкнутой
+                self.breaker.record_failure()
+                raise
+
+            if response.status_code not in RETRYABLE_STATUSES:
+                self.breaker.record_success()
+                return response
+
+            self.breaker.record_failure()
+            if self._may_retry(retries, deadline):
+                retries -= 1
+                continue
+            return response
+
+    def _may_retry(self, retries, deadline):
+        return retries > 0 and time.monotonic() < deadline and self.retry_budget.withdraw()
+
+    def get(self, *parts, **kwargs):
+        return self.request('GET', *parts, **kwargs)
+
+    def post(self, *parts, **kwargs):
+        return self.request('POST', *parts, **kwargs)
+
+    def patch(self, *parts, **kwargs):
+        return self.request('PATCH', *parts, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+
+services = {name: ServiceClient(name, uri) for name, uri in SERVICES_URI.items()}
+
+# общий на воркер пул потоков для параллельных запросов к сервисам;
+# ограничивает число одновременных запросов из одного воркера
+executor = ThreadPoolExecutor(max_workers=BACKEND_FANOUT_WORKERS)
+
+
+class FanOut:
+    """
+    Независимые запросы к сервисам в рамках одного запроса пользователя.
+
+    Запросы, отправленные через submit(), выполняются параллельно в executor,
+    а их результаты ждутся до общего дедлайна: время ответа страницы определяется
+    самой долгой цепочкой зависимых запросов, а не суммой всех.
+
+        with FanOut() as fanout:
+            user = fanout.submit(services['profiles'].get, user_id)
+            tutors = fanout.submit(get_tutors)
+            user_response, tutors = fanout.result(user), fanout.result(tutors)
+
+    Внутри submit() не стоит снова пользоваться executor и ждать результата:
+    при занятом пуле такие вложенные ожидания могут никогда не завершиться.
+    """
+
+    def __init__(self, timeout=BACKEND_FANOUT_TIMEOUT):
+        self.deadline = time.monotonic() + timeout
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        future = executor.submit(metrics.bind(fn), *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def result(self, future):
+        try:
+            return future.result(timeout=max(self.deadline - time.monotonic(), 0))
+        except TimeoutError:
+            future.cancel()
+            raise requests.exceptions.Timeout('fan-out deadline exceeded')
+
+    def join(self):
+        return [self.result(future) for future in self.futures]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # ещё не начатые запросы после выхода никому не нужны
+        for future in self.futures:
+            future.cancel()
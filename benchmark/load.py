@@ -0,0 +1,201 @@
+"""
+Нагрузочный прогон фронтенда.
+
+Виртуальные пользователи (студенты и преподаватели из заглушек сервисов) входят
+через /sign_in, после чего в течение --duration секунд открывают /lessons,
+/lessons/<number> и /me, отправляют решения и ставят оценки по одной и сразу всем. В конце печатается
+пропускная способность и p50/p95/p99 времени ответа по каждому сценарию.
+
+    python -m benchmark.load --frontend http://localhost:5000 --stubs http://localhost:5100/api --users 50
+"""
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+import simplejson
+
+from benchmark.stubs import PASSWORD
+
+# сценарии и их относительная частота для студентов и преподавателей
+STUDENT_ACTIONS = [('lessons', 5), ('lesson', 4), ('me', 1), ('answer', 1)]
+TUTOR_ACTIONS = [('lessons', 5), ('lesson', 4), ('me', 1), ('mark', 1), ('marks', 1)]
+
+
+def fetch_all(stubs, collection):
+    objects = []
+    page = 1
+    total_pages = 1
+    while page <= total_pages:
+        response = requests.get('%s/%s' % (stubs, collection), params={'page': page, 'results_per_page': 100})
+        response.raise_for_status()
+        objects.extend(response.json()['objects'])
+        total_pages = response.json()['total_pages']
+        page += 1
+    return objects
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, action, seconds, ok):
+        with self.lock:
+            self.latencies[action].append(seconds)
+            if not ok:
+                self.errors[action] += 1
+
+    def report(self, elapsed):
+        lines = ['%-10s %8s %8s %9s %8s %8s %8s' % ('action', 'requests', 'errors', 'req/s', 'p50, ms', 'p95, ms',
+                                                    'p99, ms')]
+        total = 0
+        for action in sorted(self.latencies):
+            latencies = sorted(self.latencies[action])
+            total += len(latencies)
+            lines.append('%-10s %8d %8d %9.1f %8.1f %8.1f %8.1f' % (
+                action, len(latencies), self.errors[action], len(latencies) / elapsed,
+                percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+            ))
+        lines.append('total: %d requests in %.1f s, %.1f req/s' % (total, elapsed, total / elapsed))
+        return '\n'.join(lines)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
+
+
+class VirtualUser:
+    def __init__(self, frontend, user, lessons, stats, rnd):
+        self.frontend = frontend
+        self.user = user
+        self.lessons = lessons
+        self.stats = stats
+        self.rnd = rnd
+        self.http = requests.Session()
+
+    def call(self, action, method, path, ok_statuses=(200,), **kwargs):
+        started_at = time.perf_counter()
+        try:
+            response = self.http.request(method, self.frontend + path, allow_redirects=False, **kwargs)
+            ok = response.status_code in ok_statuses
+        except requests.exceptions.RequestException:
+            ok = False
+        self.stats.record(action, time.perf_counter() - started_at, ok)
+
+    def sign_in(self):
+        self.call('sign_in', 'POST', '/sign_in', ok_statuses=(303,), data={
+            'phone': self.user['phone'],
+            'password': PASSWORD,
+        })
+
+    def run(self, deadline):
+        self.sign_in()
+        actions = STUDENT_ACTIONS if self.user['role'] == 'student' else TUTOR_ACTIONS
+        names = [name for name, weight in actions for _ in range(weight)]
+        while time.monotonic() < deadline:
+            getattr(self, 'do_' + self.rnd.choice(names))()
+
+    def do_lessons(self):
+        self.call('lessons', 'GET', '/lessons')
+
+    def do_lesson(self):
+        lesson = self.rnd.choice(self.lessons)
+        self.call('lesson', 'GET', '/lessons/%s' % lesson['number'])
+
+    def do_me(self):
+        self.call('me', 'GET', '/me')
+
+    def do_answer(self):
+        lessons = [lesson for lesson in self.lessons if lesson['task_id'] is not None]
+        if not lessons:
+            return self.do_lesson()
+        lesson = self.rnd.choice(lessons)
+        self.call('answer', 'POST', '/lessons/%s' % lesson['number'], ok_statuses=(302, 303), data={
+            'update_answer': '',
+            'lesson_id': lesson['id'],
+            'answer': 'Ответ из нагрузочного теста',
+        })
+
+    def do_mark(self):
+        lessons = [lesson for lesson in self.lessons if lesson['answers']]
+        if not lessons:
+            return self.do_lesson()
+        lesson = self.rnd.choice(lessons)
+        answer = self.rnd.choice(lesson['answers'])
+        self.call('mark', 'POST', '/lessons/%s' % lesson['number'], ok_statuses=(302, 303), data={
+            'mark_answer': '',
+            'lesson_id': lesson['id'],
+            'student_id': answer['student_id'],
+            'mark': self.rnd.choice(['2', '3', '4', '5']),
+        })
+
+    def do_marks(self):
+        lessons = [lesson for lesson in self.lessons if lesson['answers']]
+        if not lessons:
+            return self.do_lesson()
+        lesson = self.rnd.choice(lessons)
+        data = {'lesson_id': lesson['id']}
+        for answer in lesson['answers']:
+            data['mark-%d' % answer['student_id']] = self.rnd.choice(['2', '3', '4', '5'])
+        self.call('marks', 'POST', '/lessons/%s/marks' % lesson['number'], ok_statuses=(303,), data=data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frontend', default='http://localhost:5000')
+    parser.add_argument('--stubs', default='http://localhost:5100/api', help='адрес API заглушек сервисов')
+    parser.add_argument('--users', type=int, default=20, help='число одновременно работающих пользователей')
+    parser.add_argument('--tutors-share', type=float, default=0.1, help='доля преподавателей среди пользователей')
+    parser.add_argument('--duration', type=float, default=30, help='длительность прогона, в секундах')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    profiles = fetch_all(args.stubs, 'profiles')
+    lessons = fetch_all(args.stubs, 'lessons')
+    lessons_of = defaultdict(list)
+    for lesson in lessons:
+        lessons_of[lesson['tutor_id']].append(lesson)
+
+    tutors = [profile for profile in profiles if profile['role'] == 'tutor']
+    students = [profile for profile in profiles if profile['role'] == 'student']
+    tutors_count = min(max(int(args.users * args.tutors_share), 1), len(tutors))
+    users = rnd.sample(tutors, tutors_count) + rnd.sample(students, min(args.users - tutors_count, len(students)))
+
+    stats = Stats()
+    virtual_users = [VirtualUser(args.frontend, user,
+                                 lessons_of[user['id'] if user['role'] == 'tutor' else user['tutor_id']],
+                                 stats, random.Random(rnd.random()))
+                     for user in users]
+    deadline = time.monotonic() + args.duration
+    started_at = time.perf_counter()
+    threads = [threading.Thread(target=virtual_user.run, args=(deadline,)) for virtual_user in virtual_users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    if args.json:
+        print(simplejson.dumps({action: {
+            'requests': len(latencies),
+            'errors': stats.errors[action],
+            'rps': len(latencies) / elapsed,
+            'p50': percentile(sorted(latencies), 50),
+            'p95': percentile(sorted(latencies), 95),
+            'p99': percentile(sorted(latencies), 99),
+        } for action, latencies in stats.latencies.items()}, indent=2))
+    else:
+        print(stats.report(elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Локальные заглушки сервисов sessions, profiles, tasks и lessons.
+
+Говорят на том же протоколе, что и настоящие сервисы (flask-restless): фильтры
+в параметре q, постраничная выдача, POST/PATCH коллекций. Данные генерируются
+при запуске и живут в памяти процесса.
+
+    python -m benchmark.stubs --port 5100 --latency 0.05 --tutors 5 --students 150 --lessons 40 --answers 25
+
+после чего фронтенд запускается с SERVICES_BASE_URI=http://localhost:5100/api
+"""
+import argparse
+import itertools
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import flask
+import simplejson
+
+from tools import hash_password, render_datetime
+
+PASSWORD = 'password'
+COLLECTIONS = ('sessions', 'profiles', 'tasks', 'lessons')
+
+
+class Collection:
+    def __init__(self):
+        self.objects = dict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, obj):
+        with self.lock:
+            obj['id'] = next(self.ids)
+            self.objects[obj['id']] = obj
+        return obj
+
+
+def phone(user_id):
+    return '7%010d' % user_id
+
+
+def build_dataset(tutors, students, lessons, answers, seed=0):
+    """
+    tutors преподавателей, students студентов, распределённых между ними по кругу,
+    lessons уроков у каждого преподавателя и до answers ответов на каждый урок
+    """
+    rnd = random.Random(seed)
+    data = {name: Collection() for name in COLLECTIONS}
+    now = datetime.now()
+
+    def profile(role, number, **kwargs):
+        user = data['profiles'].add(dict({
+            'name': 'Имя%d' % number,
+            'surname': 'Фамилия%d' % number,
+            'middle_name': 'Отчество%d' % number,
+            'password_hash': hash_password(PASSWORD),
+            'email': None,
+            'role': role,
+            'group': None,
+            'tutor_id': None,
+            'about': None,
+            'photo': 'photo.jpg',
+        }, **kwargs))
+        user['phone'] = phone(user['id'])
+        return user
+
+    tutor_list = [profile('tutor', number) for number in range(tutors)]
+    students_of = {tutor['id']: [] for tutor in tutor_list}
+    for number in range(students):
+        tutor = tutor_list[number % len(tutor_list)]
+        students_of[tutor['id']].append(profile('student', number, group='ИУ7-%d' % (number % 10),
+                                                tutor_id=tutor['id']))
+
+    for tutor in tutor_list:
+        for number in range(1, lessons + 1):
+            created_at = render_datetime(now - timedelta(days=lessons - number))
+            task_id = None
+            if number < lessons:
+                task_id = data['tasks'].add({
+                    'task': 'Задание к уроку %d. ' % number + 'Lorem ipsum dolor sit amet. ' * 20,
+                    'created_at': created_at,
+                    'last_updated_at': created_at,
+                })['id']
+            lesson_answers = []
+            if task_id is not None:
+                for student in rnd.sample(students_of[tutor['id']], min(answers, len(students_of[tutor['id']]))):
+                    lesson_answers.append({
+                        'id': len(lesson_answers) + 1,
+                        'student_id': student['id'],
+                        'answer': 'Ответ студента. ' * rnd.randint(5, 50),
+                        'mark': rnd.choice([None, 2, 3, 4, 5]),
+                        'created_at': created_at,
+                        'last_updated_at': created_at,
+                    })
+            data['lessons'].add({
+                'number': str(number),
+                'tutor_id': tutor['id'],
+                'task_id': task_id,
+                'created_at': created_at,
+                'answers': lesson_answers,
+            })
+
+    return data
+
+
+def matches(obj, flt):
+    if 'or' in flt:
+        return any(matches(obj, f) for f in flt['or'])
+    if 'and' in flt:
+        return all(matches(obj, f) for f in flt['and'])
+
+    value = obj.get(flt['name'])
+    op = flt['op']
+    if op in ('==', 'eq', 'equals'):
+        # идентификаторы из форм фронтенда приходят строками
+        return value == flt['val'] or (value is not None and flt['val'] is not None and str(value) == str(flt['val']))
+    if op in ('!=', 'neq', 'not_equal_to'):
+        return not matches(obj, dict(flt, op='=='))
+    if op == 'in':
+        return value in flt['val']
+    if op == 'not_in':
+        return value not in flt['val']
+    if op == 'is_null':
+        return value is None
+    if op == 'is_not_null':
+        return value is not None
+    if op == 'any':
+        return any(matches(item, flt['val']) for item in value)
+    if op == 'has':
+        return value is not None and matches(value, flt['val'])
+    flask.abort(400)
+
+
+def add_answers(answers, added):
+    by_id = {answer['id']: answer for answer in answers}
+    for answer in added:
+        if answer.get('id') in by_id:
+            by_id[answer['id']].update(answer)
+        else:
+            answer['id'] = max(by_id, default=0) + 1
+            by_id[answer['id']] = answer
+            answers.append(answer)
+
+
+def create_app(data, latency=0.0):
+    app = flask.Flask(__name__)
+
+    @app.before_request
+    def simulate_latency():
+        if latency:
+            time.sleep(latency)
+
+    def get_collection(name):
+        if name not in data:
+            flask.abort(404)
+        return data[name]
+
+    @app.route('/api/<name>', methods=['GET'])
+    def search(name):
+        collection = get_collection(name)
+        query = simplejson.loads(flask.request.args.get('q', '{}'))
+        with collection.lock:
+            objects = [obj for obj in collection.objects.values()
+                       if all(matches(obj, flt) for flt in query.get('filters', []))]
+        for order in reversed(query.get('order_by', [])):
+            objects.sort(key=lambda obj: obj.get(order['field']), reverse=order.get('direction') == 'desc')
+
+        if query.get('single'):
+            if len(objects) != 1:
+                return flask.jsonify({'message': 'No result found'}), 404
+            return flask.jsonify(objects[0])
+
+        results_per_page = min(flask.request.args.get('results_per_page', 10, type=int), 100)
+        page = flask.request.args.get('page', 1, type=int)
+        return flask.jsonify({
+            'num_results': len(objects),
+            'page': page,
+            'total_pages': max((len(objects) + results_per_page - 1) // results_per_page, 1),
+            'objects': objects[(page - 1) * results_per_page:page * results_per_page],
+        })
+
+    @app.route('/api/<name>/<int:obj_id>', methods=['GET'])
+    def get(name, obj_id):
+        obj = get_collection(name).objects.get(obj_id)
+        if obj is None:
+            return flask.jsonify({'message': 'No result found'}), 404
+        return flask.jsonify(obj)
+
+    @app.route('/api/<name>', methods=['POST'])
+    def create(name):
+        obj = flask.request.get_json()
+        if name == 'sessions':
+            obj.setdefault('user_id', None)
+            obj.setdefault('data_items', [])
+        if name == 'lessons':
+            obj.setdefault('task_id', None)
+            obj.setdefault('answers', [])
+        return flask.jsonify(get_collection(name).add(obj)), 201
+
+    @app.route('/api/<name>/<int:obj_id>', methods=['PATCH'])
+    def update(name, obj_id):
+        collection = get_collection(name)
+        with collection.lock:
+            obj = collection.objects.get(obj_id)
+            if obj is None:
+                return flask.jsonify({'message': 'No result found'}), 404
+            changes = flask.request.get_json()
+            if isinstance(changes.get('answers'), dict):
+                # {'answers': {'add': [...]}} - обновить или добавить отдельные ответы
+                add_answers(obj['answers'], changes.pop('answers').get('add', []))
+            obj.update(changes)
+        return flask.jsonify(obj)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка каждого ответа, в секундах')
+    parser.add_argument('--tutors', type=int, default=5)
+    parser.add_argument('--students', type=int, default=150)
+    parser.add_argument('--lessons', type=int, default=40, help='уроков у каждого преподавателя')
+    parser.add_argument('--answers', type=int, default=25, help='ответов на каждый урок')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = build_dataset(args.tutors, args.students, args.lessons, args.answers, args.seed)
+    create_app(data, args.latency).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
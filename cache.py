@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Потокобезопасный кэш в памяти воркера с ограниченным временем жизни записей
+    и вытеснением давно не использованных (LRU) при превышении maxsize.
+
+    Если задан stale_ttl, то в течение stale_ttl секунд после устаревания
+    get_or_load() ещё отдаёт старое значение, а свежее загружает в фоне через executor.
+    """
+
+    def __init__(self, maxsize, ttl, stale_ttl=0, executor=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.executor = executor
+
+        self._items = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        # увеличивается при каждой инвалидации, чтобы загрузка, начатая до неё,
+        # не положила в кэш уже устаревшие данные
+        self._generation = 0
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        # возвращает (значение, возраст) или None; вызывается под блокировкой
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, stored_at = item
+        age = time.monotonic() - stored_at
+        if age > self.ttl + self.stale_ttl:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value, age
+
+    def get(self, key, default=None):
+        with self._lock:
+            found = self._lookup(key)
+            if found is None or found[1] > self.ttl:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return found[0]
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._items[key] = (value, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            found = self._lookup(key)
+            if found is not None:
+                value, age = found
+                if age <= self.ttl:
+                    self.hits += 1
+                    return value
+                if self.executor is not None:
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        self.executor.submit(self._refresh, key, loader, self._generation)
+                    return value
+            self.misses += 1
+            generation = self._generation
+
+        value = loader()
+        self.set(key, value, generation)
+        return value
+
+    def _refresh(self, key, loader, generation):
+        try:
+            self.set(key, loader(), generation)
+        except Exception:
+            # не удалось обновить - останется старое значение до истечения stale_ttl
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class LastKnownGoodCache:
+    """
+    Последние удачно загруженные данные страниц на случай недоступности сервисов.
+
+    get_or_load() загружает данные и запоминает их. Если загрузка не удалась
+    с одной из ошибок errors, отдаются запомненные данные не старше max_age, а ключ
+    на retry_after секунд помечается сбойным: в это время данные отдаются сразу,
+    без ожидания сервисов, а свежие загружаются в фоне через executor.
+    """
+
+    def __init__(self, maxsize, max_age, retry_after, executor, errors=(Exception,)):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self.executor = executor
+        self.errors = errors
+
+        # ключ -> (значение, когда загружено, когда не удалось обновить или None)
+        self._items = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        self.stale_hits = 0
+        self.failures = 0
+
+    def _lookup(self, key):
+        # вызывается под блокировкой
+        item = self._items.get(key)
+        if item is not None and time.time() - item[1] > self.max_age:
+            del self._items[key]
+            return None
+        return item
+
+    def _store(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.time(), None)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Возвращает (значение, None) для свежих данных или (значение, время их загрузки
+        в секундах от эпохи) для запомненных; если запомненных нет, ошибка пробрасывается
+        """
+        with self._lock:
+            item = self._lookup(key)
+            if item is not None and item[2] is not None and time.time() - item[2] < self.retry_after:
+                return self._stale(key, loader, item)
+
+        try:
+            value = loader()
+        except self.errors:
+            with self._lock:
+                self.failures += 1
+                item = self._lookup(key)
+                if item is None:
+                    raise
+                item = self._items[key] = (item[0], item[1], time.time())
+                return self._stale(key, loader, item)
+
+        self._store(key, value)
+        return value, None
+
+    def _stale(self, key, loader, item):
+        # вызывается под блокировкой
+        self.stale_hits += 1
+        if key not in self._refreshing:
+            self._refreshing.add(key)
+            self.executor.submit(self._refresh, key, loader)
+        return item[0], item[1]
+
+    def _refresh(self, key, loader):
+        try:
+            self._store(key, loader())
+        except Exception:
+            # сервисы всё ещё недоступны: данные и дальше отдаются сразу, а при
+            # следующем обращении после этого снова пробуем обновить их в фоне
+            with self._lock:
+                item = self._lookup(key)
+                if item is not None:
+                    self._items[key] = (item[0], item[1], time.time())
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'stale_hits': self.stale_hits,
+                'failures': self.failures,
+            }
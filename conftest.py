@@ -0,0 +1 @@
+# корневой conftest.py: pytest добавляет его каталог в sys.path, и тесты импортируют модули приложения
@@ -1,23 +1,138 @@
 import requests
 import simplejson
-from urllib.parse import unquote as urldecode
-from werkzeug.utils import secure_filename
+from concurrent.futures import ThreadPoolExecutor
+from markupsafe import Markup
+from urllib.parse import quote as urlencode
 from datetime import datetime
 
+import mimetypes
 import os
+import time
 import flask
-
+from jinja2 import FileSystemBytecodeCache
+
+import assets
+import avatars
+import metrics
+from backend import FanOut, executor, services
+from cache import LastKnownGoodCache, TTLCache
+from models import Answer, Lesson, Profile
 from session_interface import SessionInterface
-from settings import DEBUG_MODE, PORT, SERVICES_URI, UPLOAD_FOLDER
-from tools import hash_password, render_datetime
-
-
-app = flask.Flask(__name__)
+from settings import DEBUG_MODE, PORT, PROFILES_BATCH_SIZE, UPLOAD_FOLDER, AVATAR_MAX_SIZE, \
+    AVATAR_CACHE_MAX_AGE, STATIC_PATH, STATIC_BUILD_PATH, STATIC_FINGERPRINTS, STATIC_CACHE_MAX_AGE, \
+    TUTORS_CACHE_TTL, TUTORS_CACHE_STALE_TTL, PROFILES_CACHE_TTL, PROFILES_CACHE_SIZE, \
+    LESSONS_PER_PAGE, LESSONS_SELECTED_LIMIT, LESSONS_SELECTED_PAGE_SIZE, \
+    LESSONS_SELECTED_BATCH, LESSONS_SELECTED_MAX_PAGES, \
+    FRAGMENTS_CACHE_TTL, FRAGMENTS_CACHE_SIZE, TEMPLATES_PATH, \
+    LAST_KNOWN_GOOD_SIZE, LAST_KNOWN_GOOD_MAX_AGE, LAST_KNOWN_GOOD_RETRY_AFTER, LAST_KNOWN_GOOD_REFRESH_WORKERS, \
+    TEMPLATES_BYTECODE_PATH, WARM_UP_CONNECTIONS, WARM_UP_TIMEOUT
+from tools import hash_password, make_version, render_datetime
+
+
+# статика отдаётся get_static ниже
+app = flask.Flask(__name__, static_folder=None)
 app.config['DEBUG'] = DEBUG_MODE
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# запрос с фото больше лимита отклоняется ещё до разбора формы; запас - на остальные поля
+app.config['MAX_CONTENT_LENGTH'] = AVATAR_MAX_SIZE + 64 * 1024
 
 app.session_interface = SessionInterface()
 
+# скомпилированные шаблоны хранятся на диске, и новые воркеры не компилируют их заново
+os.makedirs(TEMPLATES_BYTECODE_PATH, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATES_BYTECODE_PATH)
+
+# имя файла в static/ -> имя его копии с хэшем содержимого в STATIC_BUILD_PATH
+STATIC_MANIFEST = assets.build() if STATIC_FINGERPRINTS else dict()
+STATIC_BUILT = frozenset(STATIC_MANIFEST.values())
+
+
+def read_templates():
+    for path, _, names in sorted(os.walk(TEMPLATES_PATH)):
+        for name in sorted(names):
+            with open(os.path.join(path, name), 'rb') as f:
+                yield f.read()
+
+
+# ETag страниц зависит и от шаблонов и статики, на которую они ссылаются,
+# чтобы после их изменения браузеры не показывали старую разметку
+TEMPLATES_VERSION = make_version(sorted(STATIC_MANIFEST.items()), *read_templates())
+
+metrics.init_app(app)
+
+tutors_cache = TTLCache(maxsize=1, ttl=TUTORS_CACHE_TTL, stale_ttl=TUTORS_CACHE_STALE_TTL, executor=executor)
+# профили вошедших пользователей по id: нужны почти на каждой странице ради role и tutor_id
+profiles_cache = TTLCache(maxsize=PROFILES_CACHE_SIZE, ttl=PROFILES_CACHE_TTL)
+# отрисованные списки на страницах уроков по версии данных, из которых они построены
+fragments_cache = TTLCache(maxsize=FRAGMENTS_CACHE_SIZE, ttl=FRAGMENTS_CACHE_TTL)
+# данные страниц для чтения, которые показываются с предупреждением, пока сервисы недоступны
+# обновляются они в отдельных потоках: загрузчики сами ждут запросов через executor
+last_known_good = LastKnownGoodCache(maxsize=LAST_KNOWN_GOOD_SIZE, max_age=LAST_KNOWN_GOOD_MAX_AGE,
+                                     retry_after=LAST_KNOWN_GOOD_RETRY_AFTER,
+                                     executor=ThreadPoolExecutor(max_workers=LAST_KNOWN_GOOD_REFRESH_WORKERS),
+                                     errors=(requests.exceptions.RequestException,))
+
+
+@app.url_defaults
+def static_fingerprint(endpoint, values):
+    # url_for('static', filename='css/style.css') -> /static/css/style.<хэш>.css
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = STATIC_MANIFEST.get(values['filename'], values['filename'])
+
+
+@app.route('/static/<path:filename>', methods=['GET'], endpoint='static')
+def get_static(filename):
+    if filename not in STATIC_BUILT:
+        return flask.send_from_directory(STATIC_PATH, filename)
+
+    # сжатая заранее копия, если браузер её принимает
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in flask.request.accept_encodings and \
+                os.path.exists(os.path.join(STATIC_BUILD_PATH, filename + suffix)):
+            response = flask.send_from_directory(STATIC_BUILD_PATH, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = flask.send_from_directory(STATIC_BUILD_PATH, filename, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % STATIC_CACHE_MAX_AGE
+    return response
+
+
+def precompile_templates():
+    # с preload_app это делается в мастере gunicorn, и воркеры получают готовые шаблоны при fork
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def warm_up():
+    """
+    Открывает по WARM_UP_CONNECTIONS соединений к каждому сервису и загружает список
+    преподавателей, чтобы первые запросы пользователей после старта воркера не платили
+    за DNS, TLS и пробуждение dyno. Недоступные сервисы старту не мешают.
+    Возвращает (время прогрева в секундах, число неудачных запросов).
+    """
+    started_at = time.perf_counter()
+    failures = 0
+    with FanOut(timeout=WARM_UP_TIMEOUT) as fanout:
+        # запросы разных страниц, чтобы SingleFlight не объединил их в один
+        for client in services.values():
+            for page in range(1, WARM_UP_CONNECTIONS + 1):
+                fanout.submit(client.get, params={'page': page, 'results_per_page': 1})
+        fanout.submit(get_tutors)
+        for future in fanout.futures:
+            try:
+                fanout.result(future)
+            except requests.exceptions.RequestException:
+                failures += 1
+    return time.perf_counter() - started_at, failures
+
+
+@app.template_filter('clock')
+def render_clock(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%H:%M')
+
 
 @app.route('/', methods=['GET'])
 def index():
@@ -26,9 +141,6 @@ def index():
 
 @app.route('/register', methods=['GET'])
 def register():
-    if 'redirect_to' in flask.request.args:
-        flask.session['redirect_to'] = urldecode(flask.request.args['redirect_to'])
-
     if flask.session.user_id is not None:
         return flask.redirect('/me')
 
@@ -54,14 +166,19 @@ def post_to_register():
     tutor_id = None if role == 'tutor' else flask.request.form.get('tutor', None)
 
     about = flask.request.form.get('brief', None)
-    photo_file = flask.request.files['avatar']
-    photo_filename = secure_filename(photo_file.filename)
+    # фото сохраняется, только если профиль создан, но имя из его хэша нужно уже сейчас
+    try:
+        photo_filename, photo_upload = avatars.receive(flask.request.files['avatar'])
+    except avatars.AvatarTooLarge:
+        return too_large(None)
+    except avatars.NotAnImage:
+        return flask.render_template('error.html', reason='Фото должно быть в формате JPEG, PNG или GIF'), 400
 
     # дополнительная необязательная информация
     email = flask.request.form.get('email', None)
 
     try:
-        user_response = requests.post(SERVICES_URI['profiles'], json={
+        user_response = services['profiles'].post(json={
             'name': name,
             'surname': surname,
             'middle_name': middle_name,
@@ -74,29 +191,28 @@ def post_to_register():
             'about': about,
             'photo': photo_filename,
         })
+        if user_response.status_code == 201:
+            avatars.store(photo_filename, photo_upload)
     except requests.exceptions.RequestException:
         return flask.render_template('error.html', reason='Сервис пользователей недоступен'), 503
+    finally:
+        avatars.discard(photo_upload)
 
     if user_response.status_code == 201:
-        user_upload_path = os.path.join(app.config['UPLOAD_FOLDER'], phone)
-        if not os.path.exists(user_upload_path):
-            os.makedirs(user_upload_path)
-        photo_path = os.path.join(user_upload_path, photo_filename)
-        photo_file.save(photo_path)
+        if role == 'tutor':
+            tutors_cache.invalidate()
 
-        user = user_response.json()
-        flask.session.user_id = user['id']
+        user = Profile.from_json(user_response.json())
+        profiles_cache.set(user.id, user)
+        flask.session.user_id = user.id
 
-        return flask.redirect(flask.session.pop('redirect_to', '/me'), code=303)
+        return flask.redirect(redirect_target(), code=303)
 
     return flask.render_template('error.html', reason=user_response.json()), 500
 
 
 @app.route('/sign_in', methods=['GET'])
 def sign_in():
-    if 'redirect_to' in flask.request.args:
-        flask.session['redirect_to'] = urldecode(flask.request.args['redirect_to'])
-
     if flask.session.user_id is not None:
         return flask.redirect('/me')
 
@@ -106,7 +222,7 @@ def sign_in():
 @app.route('/sign_in', methods=['POST'])
 def post_to_sign_in():
     try:
-        user_response = requests.get(SERVICES_URI['profiles'], params={
+        user_response = services['profiles'].get(params={
             'q': simplejson.dumps({
                 'filters': [
                     {'name': 'phone', 'op': '==', 'val': flask.request.form['phone']},
@@ -119,9 +235,10 @@ def post_to_sign_in():
         return flask.render_template('error.html', reason='Сервис пользователей недоступен'), 503
 
     if user_response.status_code == 200:
-        user = user_response.json()
-        flask.session.user_id = user['id']
-        return flask.redirect(flask.session.pop('redirect_to', '/me'), code=303)
+        user = Profile.from_json(user_response.json())
+        profiles_cache.set(user.id, user)
+        flask.session.user_id = user.id
+        return flask.redirect(redirect_target(), code=303)
 
     return flask.render_template('error.html', reason=user_response.json()), 500
 
@@ -129,24 +246,21 @@ def post_to_sign_in():
 @app.route('/me', methods=['GET'])
 def me():
     if flask.session.user_id is None:
-        flask.session['redirect_to'] = '/me'
-        return flask.redirect('/sign_in')
+        return redirect_to_sign_in('/me')
 
+    user_id = flask.session.user_id
     try:
-        user_response = requests.get(SERVICES_URI['profiles'] + '/' + str(flask.session.user_id))
-        tutors = get_tutors()
-        assert user_response.status_code == 200
-        user = user_response.json()
+        (user, tutors), stale_since = last_known_good.get_or_load(('me', user_id), lambda: load_me(user_id))
     except requests.exceptions.RequestException:
-        user = None
+        return flask.render_template('error.html', reason='Сервис пользователей недоступен'), 503
+
+    if user is None:
+        return flask.render_template('error.html', reason='Пользователь не найден'), 500
 
-    profile_photo_name = os.path.join(user['phone'], user['photo'])
     return flask.render_template('profile/me.html',
                                  user=user, tutors=tutors,
-                                 user_photo_path=flask.url_for(
-                                     'static',
-                                     filename=os.path.join("img", profile_photo_name)
-                                 ))
+                                 user_photo_path=photo_url(user),
+                                 stale_since=stale_since)
 
 
 @app.route('/me', methods=['POST'])
@@ -166,69 +280,70 @@ def patch_me():
     user['email'] = flask.request.form.get('email', None)
 
     try:
-        user_response = requests.patch(SERVICES_URI['profiles'] + '/' + str(flask.session.user_id), json=user)
+        user_response = services['profiles'].patch(flask.session.user_id, json=user)
     except requests.exceptions.RequestException:
         return flask.render_template('error.html', reason='Сервис пользователей недоступен'), 503
+    finally:
+        profiles_cache.invalidate(flask.session.user_id)
 
     if user_response.status_code == 200:
+        tutors_cache.invalidate()
         user = user_response.json()
-        profile_photo_name = os.path.join(user['phone'], user['photo'])
         return flask.render_template('profile/me.html',
                                      user=user, tutors=get_tutors(),
-                                     user_photo_path=flask.url_for(
-                                         'static',
-                                         filename=os.path.join("img", profile_photo_name)
-                                     ))
+                                     user_photo_path=photo_url(user))
 
     return flask.render_template('error.html', reason=user_response.json()), 500
 
 
+@app.route('/avatars/<name>', methods=['GET'])
+def get_avatar(name):
+    if not avatars.is_stored(name):
+        flask.abort(404)
+    # имя файла - хэш содержимого, так что по этому адресу всегда одно и то же
+    response = flask.send_from_directory(os.path.dirname(avatars.path(name)), name,
+                                         mimetype=avatars.mimetype(name))
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % AVATAR_CACHE_MAX_AGE
+    return response
+
+
+@app.errorhandler(413)
+def too_large(error):
+    return flask.render_template('error.html', reason='Фото больше %d КБ' % (AVATAR_MAX_SIZE // 1024)), 413
+
+
 @app.route('/lessons', methods=['GET'])
 def get_lessons():
     if flask.session.user_id is None:
-        flask.session['redirect_to'] = '/lessons'
-        return flask.redirect('/sign_in')
-
-    user_role = None
-    tutor_id = None
-    if flask.session.user_id is not None:
-        try:
-            user_response = requests.get(SERVICES_URI['profiles'] + '/' + str(flask.session.user_id))
-            if user_response.status_code != 200:
-                return flask.render_template('error.html', reason=user_response.json()), 500
-
-            user = user_response.json()
-            user_role = user['role']
-            tutor_id = user['tutor_id'] if user_role == 'student' else user['id']
-        except requests.exceptions.RequestException:
-            pass
+        return redirect_to_sign_in('/lessons')
 
+    user_id = flask.session.user_id
+    page = flask.request.args.get('page', 1, type=int)
     try:
-        lessons_response = requests.get(SERVICES_URI['lessons'], params={
-            'q': simplejson.dumps({
-                'filters': [
-                    {'name': 'tutor_id', 'op': '==', 'val': tutor_id},
-                ],
-            }),
-        })
-        assert lessons_response.status_code == 200
-        lessons = lessons_response.json()
-        lessons = lessons['objects']
-        if user_role == 'tutor':
-            # для преподавателя это будут все уроки, где есть непроверенные ответы
-            selected_lessons = [l for l in lessons if None in [ans['mark'] for ans in l['answers']]]
-        else:
-            # для студента - все недорешенные уроки
-            selected_lessons = [l for l in lessons if l['task_id'] is not None and flask.session.user_id not in
-                                [ans['student_id'] for ans in l['answers']]]
-
+        (user_role, lessons, total_pages, selected_lessons), stale_since = last_known_good.get_or_load(
+            ('lessons', user_id, page), lambda: load_lessons_page(user_id, page))
     except requests.exceptions.RequestException:
         return flask.render_template('error.html', reason='Сервис заданий недоступен'), 503
 
-    return flask.render_template('tasks/lessons.html',
-                                 user_role=user_role,
-                                 selected_lessons=selected_lessons,
-                                 lessons=lessons)
+    if user_role is None:
+        return flask.render_template('error.html', reason='Пользователь не найден'), 500
+
+    lessons_version = make_version([lesson.version for lesson in lessons])
+    selected_lessons_version = make_version([lesson.version for lesson in selected_lessons])
+    etag = make_version(user_id, user_role, page, total_pages, lessons_version, selected_lessons_version, stale_since)
+
+    return conditional_response(etag, lambda: flask.render_template(
+        'tasks/lessons.html',
+        user_role=user_role,
+        lessons_html=render_fragment('tasks/lessons_list.html', ('lessons', lessons_version), lessons=lessons),
+        selected_lessons_html=render_fragment('tasks/lessons_list.html',
+                                              ('selected_lessons', user_role, selected_lessons_version),
+                                              lessons=selected_lessons),
+        page=page,
+        total_pages=total_pages,
+        stale_since=stale_since,
+    ))
 
 
 @app.route('/lessons', methods=['POST'])
@@ -239,7 +354,7 @@ def create_lesson():
     lesson['created_at'] = render_datetime(datetime.now())
 
     try:
-        lesson_response = requests.post(SERVICES_URI['lessons'], json=lesson)
+        lesson_response = services['lessons'].post(json=lesson)
     except requests.exceptions.RequestException:
         return flask.render_template('error.html', reason='Сервис заданий недоступен'), 503
 
@@ -252,79 +367,88 @@ def create_lesson():
 @app.route('/lessons/<number>', methods=['GET'])
 def get_lesson(number):
     if flask.session.user_id is None:
-        flask.session['redirect_to'] = "/lessons/%s" % number
-        return flask.redirect('/sign_in')
+        return redirect_to_sign_in("/lessons/%s" % number)
 
-    user_role = None
-    tutor_id = None
-    task = None
-    answer = None
-    if flask.session.user_id is not None:
-        try:
-            user_response = requests.get(SERVICES_URI['profiles'] + '/' + str(flask.session.user_id))
-            if user_response.status_code != 200:
-                return flask.render_template('error.html', reason=user_response.json()), 500
+    user_id = flask.session.user_id
+    try:
+        (user_role, lesson, task, answer), stale_since = last_known_good.get_or_load(
+            ('lesson', user_id, number), lambda: load_lesson_page(user_id, number))
+    except requests.exceptions.RequestException:
+        return flask.render_template('error.html', reason='Сервис заданий недоступен'), 503
 
-            user = user_response.json()
-            user_role = user['role']
-            tutor_id = user['tutor_id'] if user_role == 'student' else user['id']
-        except requests.exceptions.RequestException:
-            pass
+    if user_role is None:
+        return flask.render_template('error.html', reason='Пользователь не найден'), 500
+
+    if lesson is None:
+        return flask.render_template('tasks/lesson.html', user_role=user_role, lesson=None, task=None, answer=None,
+                                     stale_since=stale_since)
+
+    answers_version = make_version(lesson.version, [(ans.student_id, ans.student_surname, ans.student_name,
+                                                     ans.student_midname) for ans in lesson.answers])
+    etag = make_version(user_id, user_role, answers_version,
+                        task and task['last_updated_at'], answer and answer.last_updated_at, stale_since)
+
+    return conditional_response(etag, lambda: flask.render_template(
+        'tasks/lesson.html',
+        user_role=user_role,
+        lesson=lesson,
+        task=task,
+        answer=answer,
+        answers_html=render_fragment('tasks/answers_list.html', ('answers', answers_version),
+                                     lesson=lesson) if user_role == 'tutor' else None,
+        stale_since=stale_since,
+    ))
+
+
+@app.route('/lessons/<number>/marks', methods=['POST'])
+def mark_answers(number):
+    # оценки сразу за несколько ответов: поля mark-<student_id> и version-<student_id>
+    marks = dict()
+    for key, mark in flask.request.form.items():
+        if key.startswith('mark-') and mark:
+            student_id = key[len('mark-'):]
+            if not student_id.isdigit():
+                return flask.render_template('error.html', reason='Неверный id студента: %s' % student_id), 400
+            marks[int(student_id)] = mark
+
+    def change(lesson):
+        changed = []
+        for student_id, mark in marks.items():
+            answer = lesson.answer_of(student_id)
+            check_answer_version(answer, flask.request.form.get('version-%d' % student_id))
+            if str(answer.mark) != mark:
+                answer.mark = mark
+                answer.last_updated_at = render_datetime(datetime.now())
+                changed.append(answer)
+        return changed
 
     try:
-        lesson_response = requests.get(SERVICES_URI['lessons'], params={
-            'q': simplejson.dumps({
-                'filters': [
-                    {'name': 'tutor_id', 'op': '==', 'val': tutor_id},
-                    {'name': 'number', 'op': '==', 'val': number},
-                ],
-            }),
-        })
-        assert lesson_response.status_code == 200
-        lesson = lesson_response.json()['objects']
-        lesson = None if len(lesson) == 0 else lesson[0]
-
-        if lesson:
-            if lesson['task_id'] is not None:
-                task_response = requests.get(SERVICES_URI['tasks'] + "/%d" % lesson['task_id'])
-                assert task_response.status_code == 200
-                task = task_response.json()
-            if user_role == 'student':
-                student_answers = [ans for ans in lesson['answers'] if ans['student_id'] == user['id']]
-                if len(student_answers) > 0:
-                    assert len(student_answers) == 1
-                    answer = student_answers[0]
-            else:
-                for ans in lesson['answers']:
-                    student = requests.get(SERVICES_URI['profiles'] + "/%s" % ans['student_id']).json()
-                    ans['student_name'] = student['name']
-                    ans['student_surname'] = student['surname']
-                    ans['student_midname'] = student['middle_name']
+        lesson_response = save_answers(flask.request.form['lesson_id'], change)
+    except AnswerConflict:
+        return flask.render_template('error.html', reason=ANSWER_CONFLICT_REASON), 409
     except requests.exceptions.RequestException:
-        lesson = None
+        return flask.render_template('error.html', reason='Сервис заданий недоступен'), 503
+
+    if lesson_response is None or lesson_response.status_code == 200:
+        return flask.redirect("/lessons/%s" % number, code=303)
 
-    return flask.render_template('tasks/lesson.html',
-                                 user_role=user_role,
-                                 lesson=lesson,
-                                 task=task,
-                                 answer=answer)
+    return flask.render_template('error.html', reason=lesson_response.json()), 500
 
 
 @app.route('/lessons/<number>', methods=['POST'])
 def update_lesson(number):
     try:
-        print(flask.request.form)
         if 'create_task' in flask.request.form:
             task = dict()
             task['task'] = flask.request.form['task']
             task['created_at'] = render_datetime(datetime.now())
             task['last_updated_at'] = render_datetime(datetime.now())
 
-            task_response = requests.post(SERVICES_URI['tasks'], json=task)
+            task_response = services['tasks'].post(json=task)
             if task_response.status_code == 201:
                 created_task = task_response.json()
-                requests.patch(SERVICES_URI['lessons'] + '/' + str(flask.request.form['lesson_id']),
-                               json={'task_id': created_task['id']})
+                services['lessons'].patch(flask.request.form['lesson_id'],
+                                          json={'task_id': created_task['id']})
                 return flask.redirect("/lessons/%s" % number)
 
             return flask.render_template('error.html', reason=task_response.json()), 500
@@ -334,72 +458,344 @@ def update_lesson(number):
             task['task'] = flask.request.form['task']
             task['last_updated_at'] = render_datetime(datetime.now())
 
-            task_response = requests.patch("%s/%s" % (SERVICES_URI['tasks'], flask.request.form['task_id']),
-                                           json=task)
+            task_response = services['tasks'].patch(flask.request.form['task_id'], json=task)
             if task_response.status_code == 200:
                 return flask.redirect("/lessons/%s" % number)
 
             return flask.render_template('error.html', reason=task_response.json()), 500
 
         elif 'update_answer' in flask.request.form:
-            lesson_response = requests.get("%s/%s" % (SERVICES_URI['lessons'], flask.request.form['lesson_id']))
-            answers = lesson_response.json()['answers']
-            student_answers_indexes = [ind for ind, ans in enumerate(answers)
-                                       if ans['student_id'] == flask.session.user_id]
-            if len(student_answers_indexes) > 0:
-                assert len(student_answers_indexes) == 1
-                answer = answers[student_answers_indexes[0]]
-                answer['mark'] = None
-            else:
-                answer = dict()
-                answer['student_id'] = flask.session.user_id
-                answer['created_at'] = render_datetime(datetime.now())
-                answers.append(answer)
-
-            answer['answer'] = flask.request.form['answer']
-            answer['last_updated_at'] = render_datetime(datetime.now())
-            lesson_response = requests.patch("%s/%s" % (SERVICES_URI['lessons'], flask.request.form['lesson_id']),
-                                             json={'answers': answers})
-            if lesson_response.status_code == 200:
+            def change(lesson):
+                answer = lesson.answer_of(flask.session.user_id)
+                if answer is None:
+                    answer = Answer(student_id=flask.session.user_id, created_at=render_datetime(datetime.now()))
+                elif flask.request.form.get('answer_version'):
+                    check_answer_version(answer, flask.request.form['answer_version'])
+
+                answer.answer = flask.request.form['answer']
+                answer.mark = None
+                answer.last_updated_at = render_datetime(datetime.now())
+                return [answer]
+
+            lesson_response = save_answers(flask.request.form['lesson_id'], change)
+            if lesson_response is None or lesson_response.status_code == 200:
                 return flask.redirect("/lessons/%s" % number)
 
             return flask.render_template('error.html', reason=lesson_response.json()), 500
 
         elif 'mark_answer' in flask.request.form:
-            lesson_response = requests.get("%s/%s" % (SERVICES_URI['lessons'], flask.request.form['lesson_id']))
-            answers = lesson_response.json()['answers']
-            student_id = int(flask.request.form['student_id'])
-            student_answers_indexes = [ind for ind, ans in enumerate(answers)
-                                       if ans['student_id'] == student_id]
-            assert len(student_answers_indexes) == 1
-            answer = answers[student_answers_indexes[0]]
-            answer['mark'] = flask.request.form['mark']
-            answer['last_updated_at'] = render_datetime(datetime.now())
-            lesson_response = requests.patch("%s/%s" % (SERVICES_URI['lessons'], flask.request.form['lesson_id']),
-                                             json={'answers': answers})
-            if lesson_response.status_code == 200:
+            def change(lesson):
+                answer = lesson.answer_of(int(flask.request.form['student_id']))
+                check_answer_version(answer, flask.request.form.get('answer_version'))
+
+                answer.mark = flask.request.form['mark']
+                answer.last_updated_at = render_datetime(datetime.now())
+                return [answer]
+
+            lesson_response = save_answers(flask.request.form['lesson_id'], change)
+            if lesson_response is None or lesson_response.status_code == 200:
                 return flask.redirect("/lessons/%s" % number)
 
             return flask.render_template('error.html', reason=lesson_response.json()), 500
 
+    except AnswerConflict:
+        return flask.render_template('error.html', reason=ANSWER_CONFLICT_REASON), 409
     except requests.exceptions.RequestException:
         return flask.render_template('error.html', reason='Сервис заданий недоступен'), 503
 
     return flask.render_template('error.html', reason='Внутренняя ошибка. Что-то пошло не так.'), 500
 
 
+class AnswerConflict(Exception):
+    """Ответ изменился с тех пор, как пользователь открыл страницу"""
+
+
+ANSWER_CONFLICT_REASON = 'Ответ изменился, пока страница была открыта. Обновите страницу и повторите.'
+
+
+def check_answer_version(answer, version):
+    # version - last_updated_at ответа на момент, когда пользователь открыл страницу
+    if answer is None or (version is not None and answer.last_updated_at != version):
+        raise AnswerConflict()
+
+
+def save_answers(lesson_id, change):
+    """
+    Изменяет ответы урока: change(lesson) меняет нужные ответы урока и возвращает их,
+    а в сервис уходят только они, без остальных ответов.
+    Возвращает ответ сервиса или None, если менять было нечего.
+
+    Конфликты ловит только change через check_answer_version - с версией ответа из формы.
+    Сервис уроков (flask-restless) одновременные PATCH не сравнивает, поэтому запись,
+    сделанная между чтением урока здесь и PATCH, может быть перезаписана.
+    """
+    lesson_response = services['lessons'].get(lesson_id)
+    lesson_response.raise_for_status()
+    changed = change(Lesson.from_json(lesson_response.json()))
+    if not changed:
+        return None
+
+    return services['lessons'].patch(lesson_id, json={
+        'answers': {'add': [answer.to_json() for answer in changed]},
+    })
+
+
+def query_lessons(filters, page=1, results_per_page=LESSONS_PER_PAGE, select=None, direction='asc'):
+    """
+    Одна страница уроков, подходящих под filters, в порядке создания ('asc') или от новых к старым ('desc').
+    Возвращает уроки без самих ответов и общее число страниц.
+    select - необязательный дополнительный отбор по уроку
+    """
+    lessons_response = services['lessons'].get(params={
+        'q': simplejson.dumps({
+            'filters': filters,
+            'order_by': [{'field': 'id', 'direction': direction}],
+        }),
+        'page': page,
+        'results_per_page': results_per_page,
+    })
+    lessons_response.raise_for_status()
+    lessons = lessons_response.json()
+
+    selected = [lesson for lesson in (Lesson.from_json(lesson, with_answers=False) for lesson in lessons['objects'])
+                if select is None or select(lesson)]
+
+    return selected, lessons.get('total_pages', 1)
+
+
+def get_selected_lessons(user_role, tutor_id, user_id):
+    if user_role == 'tutor':
+        # для преподавателя это будут все уроки, где есть непроверенные ответы
+        lessons, _ = query_lessons([
+            {'name': 'tutor_id', 'op': '==', 'val': tutor_id},
+            {'name': 'answers', 'op': 'any', 'val': {'name': 'mark', 'op': 'is_null'}},
+        ], results_per_page=LESSONS_SELECTED_LIMIT)
+        return lessons
+
+    # для студента - недорешенные уроки; отфильтровать уроки без его ответа сервис
+    # не умеет, как и отдать уроки без текстов ответов, поэтому уроки с заданием
+    # просматриваются от новых к старым (недорешённые обычно среди последних),
+    # пока не наберётся LESSONS_SELECTED_LIMIT или не кончатся LESSONS_SELECTED_MAX_PAGES
+    filters = [
+        {'name': 'tutor_id', 'op': '==', 'val': tutor_id},
+        {'name': 'task_id', 'op': 'is_not_null'},
+    ]
+
+    def unsolved(lesson):
+        return user_id not in lesson.answered_by
+
+    selected_lessons, total_pages = query_lessons(filters, results_per_page=LESSONS_SELECTED_PAGE_SIZE,
+                                                  select=unsolved, direction='desc')
+    last_page = min(total_pages, LESSONS_SELECTED_MAX_PAGES)
+    page = 2
+    while page <= last_page and len(selected_lessons) < LESSONS_SELECTED_LIMIT:
+        with FanOut() as fanout:
+            for batch_page in range(page, min(page + LESSONS_SELECTED_BATCH, last_page + 1)):
+                fanout.submit(query_lessons, filters, batch_page, LESSONS_SELECTED_PAGE_SIZE, unsolved, 'desc')
+            for lessons, _ in fanout.join():
+                selected_lessons.extend(lessons)
+        page += LESSONS_SELECTED_BATCH
+
+    return selected_lessons[:LESSONS_SELECTED_LIMIT]
+
+
+def redirect_to_sign_in(path):
+    # адрес возврата передаётся в ссылке, а не в сессии: анонимные просмотры страниц
+    # (в том числе поисковыми роботами) не должны создавать сессий;
+    # формы входа и регистрации отправляются на тот же адрес вместе с ним
+    return flask.redirect('/sign_in?redirect_to=%s' % urlencode(path, safe='/'))
+
+
+def redirect_target():
+    path = flask.request.args.get('redirect_to', '')
+    # только адреса этого же сайта
+    if not path.startswith('/') or path.startswith('//'):
+        return '/me'
+    return path
+
+
+def conditional_response(etag, render):
+    """
+    Ответ с ETag: если у браузера уже есть страница с таким ETag, он получит 304
+    без отрисовки шаблона; иначе страница отрисовывается вызовом render()
+    """
+    etag = make_version(TEMPLATES_VERSION, etag)
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.make_response(render())
+    response.set_etag(etag)
+    # страницы личные и должны проверяться при каждом открытии
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def render_fragment(template, version, **context):
+    html = fragments_cache.get((template, version))
+    if html is None:
+        html = Markup(flask.render_template(template, **context))
+        fragments_cache.set((template, version), html)
+    return html
+
+
+def photo_url(user):
+    if avatars.is_stored(user['photo']):
+        return flask.url_for('get_avatar', name=avatars.displayed_name(user['photo']))
+    # фото профилей, зарегистрированных до появления AVATARS_PATH
+    return flask.url_for('static', filename=os.path.join('img', user['phone'], user['photo']))
+
+
+def load_me(user_id):
+    with FanOut() as fanout:
+        tutors = fanout.submit(get_tutors)
+        user = get_user(user_id)
+        tutors = fanout.result(tutors)
+    return user, tutors
+
+
+def load_lessons_page(user_id, page):
+    user = get_user(user_id)
+    if user is None:
+        return None, None, None, None
+
+    user_role = user['role']
+    tutor_id = user['tutor_id'] if user_role == 'student' else user['id']
+    # get_selected_lessons сама раздаёт запросы через executor, поэтому выполняется здесь,
+    # а в executor уходит одиночный запрос страницы уроков
+    with FanOut() as fanout:
+        lessons = fanout.submit(query_lessons, [
+            {'name': 'tutor_id', 'op': '==', 'val': tutor_id},
+        ], page=page)
+        selected_lessons = get_selected_lessons(user_role, tutor_id, user_id)
+        lessons, total_pages = fanout.result(lessons)
+    return user_role, lessons, total_pages, selected_lessons
+
+
+def load_lesson_page(user_id, number):
+    user = get_user(user_id)
+    if user is None:
+        return None, None, None, None
+
+    user_role = user['role']
+    tutor_id = user['tutor_id'] if user_role == 'student' else user['id']
+    task = None
+    answer = None
+    lesson_response = services['lessons'].get(params={
+        'q': simplejson.dumps({
+            'filters': [
+                {'name': 'tutor_id', 'op': '==', 'val': tutor_id},
+                {'name': 'number', 'op': '==', 'val': number},
+            ],
+        }),
+    })
+    lesson_response.raise_for_status()
+    lesson = lesson_response.json()['objects']
+    lesson = None if len(lesson) == 0 else Lesson.from_json(lesson[0])
+
+    if lesson:
+        with FanOut() as fanout:
+            # задание запрашивается параллельно с именами студентов
+            if lesson.task_id is not None:
+                task_response = fanout.submit(services['tasks'].get, lesson.task_id)
+
+            if user_role == 'student':
+                answer = lesson.answer_of(user.id)
+            else:
+                students = get_profiles(lesson.answered_by)
+                for ans in lesson.answers:
+                    student = students.get(ans.student_id)
+                    if student is not None:
+                        ans.student_name = student.name
+                        ans.student_surname = student.surname
+                        ans.student_midname = student.middle_name
+
+            if lesson.task_id is not None:
+                task_response = fanout.result(task_response)
+                task_response.raise_for_status()
+                task = task_response.json()
+
+    return user_role, lesson, task, answer
+
+
+def get_user(user_id):
+    user = profiles_cache.get(user_id)
+    if user is None:
+        user_response = services['profiles'].get(user_id)
+        if user_response.status_code == 404:
+            return None
+        # сбой сервиса - не "пользователь не найден": пусть страница покажется по последним данным
+        user_response.raise_for_status()
+        user = Profile.from_json(user_response.json())
+        profiles_cache.set(user_id, user)
+
+    return user
+
+
 def get_tutors():
-    tutors_response = requests.get(SERVICES_URI['profiles'], params={
+    return tutors_cache.get_or_load('tutors', load_tutors)
+
+
+def load_tutors():
+    tutors_response = services['profiles'].get(params={
         'q': simplejson.dumps({
             'filters': [
                 {'name': 'role', 'op': '==', 'val': 'tutor'},
             ],
         }),
     })
-    assert tutors_response.status_code == 200
+    tutors_response.raise_for_status()
     tutors = tutors_response.json()
 
-    return tutors['objects']
+    return [Profile.from_json(tutor) for tutor in tutors['objects']]
+
+
+def get_profiles(ids):
+    # профили запрашиваются пачками по PROFILES_BATCH_SIZE через фильтр "in" по id;
+    # всё, что так получить не удалось, запрашивается по одному, но параллельно
+    ids = list(set(ids))
+    profiles = dict()
+    for start in range(0, len(ids), PROFILES_BATCH_SIZE):
+        batch = ids[start:start + PROFILES_BATCH_SIZE]
+        profiles_response = services['profiles'].get(params={
+            'q': simplejson.dumps({
+                'filters': [
+                    {'name': 'id', 'op': 'in', 'val': batch},
+                ],
+            }),
+            'results_per_page': len(batch),
+        })
+        if profiles_response.status_code != 200:
+            break
+        for profile in profiles_response.json()['objects']:
+            profiles[profile['id']] = Profile.from_json(profile)
+
+    missing = [profile_id for profile_id in ids if profile_id not in profiles]
+    for profile_response in executor.map(metrics.bind(services['profiles'].get), missing):
+        if profile_response.status_code == 200:
+            profile = Profile.from_json(profile_response.json())
+            profiles[profile.id] = profile
+
+    return profiles
+
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    return flask.jsonify({
+        'tutors': tutors_cache.stats(),
+        'profiles': profiles_cache.stats(),
+        'last_known_good': last_known_good.stats(),
+        'coalesced_gets': {name: client.singleflight.coalesced
+                           for name, client in services.items() if client.singleflight is not None},
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return flask.Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+precompile_templates()
+
 
 if __name__ == '__main__':
     app.run(port=PORT)
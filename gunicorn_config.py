@@ -0,0 +1,62 @@
+"""
+Настройки gunicorn: gunicorn -c gunicorn_config.py frontend:app
+
+По умолчанию используются кооперативные воркеры gevent: почти всё время обработки
+запроса уходит на ожидание ответов сервисов, и один процесс может одновременно
+обслуживать сотни запросов, а не по одному на воркер, как sync-воркеры.
+Прежний режим - GUNICORN_WORKER_CLASS=sync, потоки вместо gevent - gthread.
+
+Приложение загружается один раз в мастере (preload_app): статика собирается,
+а шаблоны компилируются до fork, и воркеры стартуют уже с ними. Перед приёмом
+запросов каждый воркер открывает соединения к сервисам и загружает список
+преподавателей (WARM_UP=0 - не прогревать), время старта пишется в лог.
+"""
+import os
+import time
+
+config_loaded_at = time.perf_counter()
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# сколько запросов одновременно обрабатывает один воркер gevent
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 500))
+# потоков в воркере gthread
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+if worker_class in ('gevent', 'eventlet'):
+    # greenlet'ов много, и пул соединений к сервисам и число параллельных запросов
+    # к ним должны быть рассчитаны на них; переменные читает settings.py при загрузке приложения
+    os.environ.setdefault('BACKEND_POOL_MAXSIZE', str(min(worker_connections, 100)))
+    os.environ.setdefault('BACKEND_FANOUT_WORKERS', str(min(worker_connections, 100)))
+elif worker_class == 'gthread':
+    os.environ.setdefault('BACKEND_POOL_MAXSIZE', str(max(threads * 2, 16)))
+
+if preload_app and worker_class == 'gevent':
+    # приложение импортируется в мастере, а воркер gevent патчит модули уже после fork:
+    # созданные при импорте блокировки и потоки должны быть уже кооперативными
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def when_ready(server):
+    if preload_app:
+        server.log.info('Application loaded in %.2f s', time.perf_counter() - config_loaded_at)
+
+
+def post_fork(server, worker):
+    worker.started_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    # соединения открываются в каждом воркере: открытые в мастере до fork были бы общими
+    import frontend
+    from settings import WARM_UP
+
+    warm_up = 'off'
+    if WARM_UP:
+        seconds, failures = frontend.warm_up()
+        warm_up = '%.2f s, %d failed requests' % (seconds, failures)
+    worker.log.info('Worker %s ready in %.2f s (warm-up: %s)',
+                    worker.pid, time.perf_counter() - worker.started_at, warm_up)
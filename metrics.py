@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+
+import flask
+
+# границы корзин гистограмм, в секундах
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Гистограмма длительностей с числом наблюдений и ошибок, как в Prometheus"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, seconds, error=False):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds, error)
+
+    def render(self):
+        """Все гистограммы в текстовом формате Prometheus"""
+        with self._lock:
+            families = OrderedDict()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                families.setdefault(name, []).append((labels, histogram))
+
+            lines = []
+            for name, histograms in families.items():
+                lines.append('# TYPE %s_seconds histogram' % name)
+                for labels, histogram in histograms:
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('%s_seconds_bucket%s %d' % (name, _labels(labels, le=bound), count))
+                    lines.append('%s_seconds_bucket%s %d' % (name, _labels(labels, le='+Inf'), histogram.count))
+                    lines.append('%s_seconds_sum%s %f' % (name, _labels(labels), histogram.sum))
+                    lines.append('%s_seconds_count%s %d' % (name, _labels(labels), histogram.count))
+                lines.append('# TYPE %s_errors_total counter' % name)
+                for labels, histogram in histograms:
+                    lines.append('%s_errors_total%s %d' % (name, _labels(labels), histogram.errors))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in pairs)
+
+
+registry = Registry()
+
+# для потоков executor, выполняющих запросы от имени запроса пользователя
+_local = threading.local()
+
+
+def current_timings():
+    """Список (сервис, секунды) запросов к сервисам в рамках текущего запроса пользователя или None"""
+    timings = getattr(_local, 'timings', None)
+    if timings is None and flask.has_app_context():
+        timings = flask.g.setdefault('backend_timings', [])
+    return timings
+
+
+def bind(fn):
+    """Оборачивает fn для выполнения в другом потоке так, чтобы её запросы к сервисам
+    учитывались в Server-Timing текущего запроса пользователя"""
+    timings = current_timings()
+
+    def bound(*args, **kwargs):
+        _local.timings = timings
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.timings = None
+
+    return bound
+
+
+def observe_backend(service, method, seconds, error=False):
+    registry.observe('frontend_backend_request', {'service': service, 'method': method}, seconds, error)
+    timings = current_timings()
+    if timings is not None:
+        timings.append((service, seconds))
+
+
+def server_timing(timings, total):
+    by_service = OrderedDict()
+    for service, seconds in timings:
+        calls, duration = by_service.get(service, (0, 0.0))
+        by_service[service] = (calls + 1, duration + seconds)
+
+    entries = ['%s;dur=%.1f;desc="%d calls"' % (service, duration * 1000, calls)
+               for service, (calls, duration) in by_service.items()]
+    entries.append('total;dur=%.1f' % (total * 1000))
+    return ', '.join(entries)
+
+
+def init_app(app):
+    """
+    Замеряет время обработки каждого маршрута и добавляет к ответу заголовок
+    Server-Timing со временем запросов к каждому сервису.
+    Запись сессии происходит уже после формирования ответа и в заголовок не попадает.
+    """
+
+    @app.before_request
+    def start_timer():
+        flask.g.request_started_at = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started_at = flask.g.pop('request_started_at', None)
+        if started_at is not None:
+            total = time.perf_counter() - started_at
+            _observe_route(total, response.status_code >= 500)
+            response.headers['Server-Timing'] = server_timing(current_timings(), total)
+        return response
+
+    @app.teardown_request
+    def observe_failed_request(exc):
+        # after_request не вызывается, если обработчик упал с исключением
+        started_at = flask.g.pop('request_started_at', None)
+        if started_at is not None:
+            _observe_route(time.perf_counter() - started_at, True)
+
+
+def _observe_route(seconds, error):
+    rule = flask.request.url_rule
+    registry.observe('frontend_request', {
+        'route': rule.rule if rule is not None else 'unmatched',
+        'method': flask.request.method,
+    }, seconds, error)
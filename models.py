@@ -0,0 +1,72 @@
+from tools import make_version
+
+
+class Model:
+    """
+    Компактное представление объекта сервиса: только нужные поля в __slots__.
+    Поддерживает обращение model['field'], как к словарю из json, чтобы
+    шаблоны и остальной код не зависели от того, словарь перед ними или модель.
+    """
+
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    @classmethod
+    def from_json(cls, json):
+        return cls(**{name: json.get(name) for name in cls.fields})
+
+    def to_json(self):
+        # у ещё не созданного объекта id нет, его назначит сервис
+        return {name: getattr(self, name) for name in self.fields if name != 'id' or self.id is not None}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class Profile(Model):
+    fields = ('id', 'name', 'surname', 'middle_name', 'phone', 'email', 'role', 'group', 'tutor_id', 'about', 'photo')
+    __slots__ = fields
+
+
+class Answer(Model):
+    fields = ('id', 'student_id', 'answer', 'mark', 'created_at', 'last_updated_at')
+    # имя студента заполняется только на странице урока у преподавателя
+    __slots__ = fields + ('student_name', 'student_surname', 'student_midname')
+
+
+class Lesson(Model):
+    """
+    Урок с ответами, проиндексированными по student_id.
+
+    answered_by - id студентов, ответивших на урок, version - метка, меняющаяся
+    при любом изменении урока или его ответов; они считаются один раз при разборе
+    json, так что сами ответы можно не хранить (with_answers=False), если нужны только они.
+    """
+
+    fields = ('id', 'number', 'tutor_id', 'task_id', 'created_at')
+    __slots__ = fields + ('answers', 'answers_by_student', 'answered_by', 'version')
+
+    @classmethod
+    def from_json(cls, json, with_answers=True):
+        lesson = super().from_json(json)
+        answers = json.get('answers', [])
+        lesson.answered_by = frozenset(answer['student_id'] for answer in answers)
+        lesson.version = make_version(lesson.id, lesson.number, lesson.task_id,
+                                      [(answer['student_id'], answer['mark'], answer['last_updated_at'])
+                                       for answer in answers])
+        lesson.answers = [Answer.from_json(answer) for answer in answers] if with_answers else []
+        lesson.answers_by_student = {answer.student_id: answer for answer in lesson.answers}
+        return lesson
+
+    def answer_of(self, student_id):
+        return self.answers_by_student.get(student_id)
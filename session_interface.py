@@ -2,16 +2,48 @@ import flask
 import requests
 from datetime import datetime
 
-from settings import SERVICES_URI, SESSION_EXPIRES_AFTER
+from session_store import SESSION_STORES
+from settings import SESSION_EXPIRES_AFTER, SESSION_STORE, SESSION_TOUCH_INTERVAL
 from tools import parse_datetime, render_datetime
 
 
 class Session(dict, flask.sessions.SessionMixin):
+    """
+    Сессия, которая помнит, менялась ли она с момента загрузки (modified).
+
+    Сессия без id (new) ещё не создана в сервисе сессий: она создаётся
+    при сохранении, только если в неё что-то записали.
+    """
+
     def __init__(self, json, **kwargs):
         super().__init__(**kwargs)
         self.id = json['id']
-        self.user_id = json['user_id']
-        self.data = {item['key']: item['value'] for item in json['data_items']}
+        self._user_id = json['user_id']
+        self.last_used_at = parse_datetime(json.get('last_used_at'))
+        dict.update(self, {item['key']: item['value'] for item in json['data_items']})
+
+        self.new = self.id is None
+        self.modified = False
+        # у пользователя есть cookie с сессией, которая истекла или не найдена
+        self.stale_cookie = False
+
+    @classmethod
+    def empty(cls):
+        return cls({
+            'id': None,
+            'user_id': None,
+            'data_items': [],
+        })
+
+    @property
+    def user_id(self):
+        return self._user_id
+
+    @user_id.setter
+    def user_id(self, user_id):
+        if user_id != self._user_id:
+            self._user_id = user_id
+            self.modified = True
 
     @property
     def data(self):
@@ -22,6 +54,41 @@ class Session(dict, flask.sessions.SessionMixin):
         self.clear()
         self.update(data)
 
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            self.modified = True
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.modified = True
+        super().__delitem__(key)
+
+    def clear(self):
+        if len(self) > 0:
+            self.modified = True
+        super().clear()
+
+    def pop(self, key, *args):
+        if key in self:
+            self.modified = True
+        return super().pop(key, *args)
+
+    def popitem(self):
+        self.modified = True
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.modified = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.modified = True
+        super().update(*args, **kwargs)
+
+    def needs_touch(self, now):
+        return self.last_used_at is None or now - self.last_used_at >= SESSION_TOUCH_INTERVAL
+
     def to_json(self):
         return {
             'user_id': self.user_id,
@@ -31,36 +98,64 @@ class Session(dict, flask.sessions.SessionMixin):
 
 
 class SessionInterface(flask.sessions.SessionInterface):
+    def __init__(self, store=None):
+        self.store = store if store is not None else SESSION_STORES[SESSION_STORE]()
+
     def open_session(self, app, request):
+        session = Session.empty()
+        if 'session_id' not in request.cookies:
+            return session
+
         try:
-            if 'session_id' in request.cookies:
-                session_response = requests.get(SERVICES_URI['sessions'] + '/' + request.cookies['session_id'])
-                if session_response.status_code == 200:
-                    session = session_response.json()
-                    if parse_datetime(session['last_used_at']) + SESSION_EXPIRES_AFTER > datetime.now():
-                        return Session(session)
-
-            session_response = requests.post(SERVICES_URI['sessions'], json={
-                'last_used_at': render_datetime(datetime.now()),
-            })
-            if session_response.status_code == 201:
-                session = session_response.json()
-                return Session(session)
+            session_json = self.store.load(request.cookies['session_id'], request.cookies.get('session_rev'))
+            if session_json is not None:
+                if parse_datetime(session_json['last_used_at']) + SESSION_EXPIRES_AFTER > datetime.now():
+                    return Session(session_json)
+            session.stale_cookie = True
         except requests.exceptions.RequestException:
-            return Session({
-                'id': None,
-                'user_id': None,
-                'data_items': [],
-            })
+            # сервис сессий недоступен - cookie не трогаем, сессия может быть ещё жива
+            pass
 
-    def save_session(self, app, session, response):
-        if session.id is None:
-            response.set_cookie('session_id', '', expires=0)
-            return
+        return session
 
+    def save_session(self, app, session, response):
         try:
-            session_response = requests.patch(SERVICES_URI['sessions'] + '/' + str(session.id), json=session.to_json())
-            if session_response.status_code == 200:
-                response.set_cookie('session_id', str(session.id))
+            if session.new:
+                if session.modified:
+                    self._create(session, response)
+                elif session.stale_cookie:
+                    response.delete_cookie('session_id')
+                    response.delete_cookie('session_rev')
+                return
+
+            now = datetime.now()
+            if session.modified:
+                session_json = session.to_json()
+            elif session.needs_touch(now):
+                # ничего не поменялось - достаточно продлить жизнь сессии
+                session_json = {'last_used_at': render_datetime(now)}
+            else:
+                return
+
+            revision = self.store.update(session.id, session_json)
+            if revision is not None:
+                if session.modified:
+                    self._set_revision_cookie(response, revision)
+                session.last_used_at = now
+                session.modified = False
         except requests.exceptions.RequestException:
             pass
+
+    def _create(self, session, response):
+        session_json = self.store.create(session.to_json())
+        if session_json is not None:
+            session.id = session_json['id']
+            session.new = False
+            session.modified = False
+            response.set_cookie('session_id', str(session.id))
+            self._set_revision_cookie(response, session_json['revision'])
+
+    @staticmethod
+    def _set_revision_cookie(response, revision):
+        if revision:
+            response.set_cookie('session_rev', revision)
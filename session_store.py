@@ -0,0 +1,179 @@
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+import simplejson
+
+from backend import services
+from cache import TTLCache
+from settings import SESSION_CACHE_TTL, SESSION_CACHE_SIZE, SESSION_EXPIRES_AFTER, SESSION_SQLITE_PATH
+from tools import render_datetime
+
+
+class SessionStore:
+    """
+    Хранилище сессий для SessionInterface.
+
+    Сессии передаются в том же виде, что и в сервисе сессий:
+    {'id': ..., 'user_id': ..., 'last_used_at': ..., 'data_items': [{'key': ..., 'value': ...}]}
+
+    revision - метка версии сессии, которую SessionInterface хранит в cookie рядом с id.
+    Хранилище может использовать её, чтобы понять, не устарела ли его копия сессии.
+    """
+
+    def load(self, session_id, revision=None):
+        """Возвращает сессию или None, если её нет"""
+        raise NotImplementedError
+
+    def create(self, session_json):
+        """Создаёт сессию, возвращает её с заполненными id и revision или None"""
+        raise NotImplementedError
+
+    def update(self, session_id, session_json):
+        """Обновляет переданные поля сессии, возвращает новую revision или None"""
+        raise NotImplementedError
+
+
+class RemoteSessionStore(SessionStore):
+    """
+    Сессии в сервисе сессий с кэшем в памяти воркера перед ним.
+
+    Запись в кэше годится, только если её revision совпадает с revision из cookie:
+    после каждого изменения сессии браузер получает новую revision, поэтому
+    другой воркер со старой копией сессии заметит это и перечитает её из сервиса.
+    """
+
+    def __init__(self, cache_ttl=SESSION_CACHE_TTL, cache_size=SESSION_CACHE_SIZE):
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    def load(self, session_id, revision=None):
+        cached = self.cache.get(str(session_id))
+        if cached is not None and cached['revision'] == revision:
+            return cached
+
+        session_response = services['sessions'].get(session_id)
+        if session_response.status_code != 200:
+            self.cache.invalidate(str(session_id))
+            return None
+
+        session_json = session_response.json()
+        session_json['revision'] = revision
+        self.cache.set(str(session_id), session_json)
+        return session_json
+
+    def create(self, session_json):
+        session_response = services['sessions'].post(json=session_json)
+        if session_response.status_code != 201:
+            return None
+
+        session_json = session_response.json()
+        session_json['revision'] = uuid.uuid4().hex
+        self.cache.set(str(session_json['id']), session_json)
+        return session_json
+
+    def update(self, session_id, session_json):
+        session_response = services['sessions'].patch(session_id, json=session_json)
+        if session_response.status_code != 200:
+            self.cache.invalidate(str(session_id))
+            return None
+
+        cached = self.cache.get(str(session_id))
+        if set(session_json) == {'last_used_at'}:
+            # продление жизни сессии не меняет её содержимого и revision
+            if cached is None:
+                return ''
+            revision = cached['revision']
+        else:
+            revision = uuid.uuid4().hex
+
+        cached = dict(cached or session_response.json())
+        cached.update(session_json)
+        cached['revision'] = revision
+        self.cache.set(str(session_id), cached)
+        return revision
+
+
+class LocalSessionStore(SessionStore):
+    """
+    Сессии в локальной базе SQLite - для развёртывания на одной машине.
+    Файл базы общий для всех воркеров, поэтому кэш перед ним не нужен.
+    """
+
+    def __init__(self, path=SESSION_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                                    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'user_id INTEGER, '
+                                    'last_used_at TEXT, '
+                                    'data TEXT NOT NULL DEFAULT \'{}\')')
+
+    @property
+    def connection(self):
+        # соединение SQLite нельзя использовать из разных потоков, а после fork - и из разных
+        # процессов: с preload_app хранилище создаётся в мастере gunicorn, и воркеры наследуют его
+        connection, pid = getattr(self._local, 'connection', (None, None))
+        if connection is None or pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = (connection, os.getpid())
+        return connection
+
+    def load(self, session_id, revision=None):
+        row = self.connection.execute('SELECT id, user_id, last_used_at, data FROM sessions WHERE id = ?',
+                                      (session_id,)).fetchone()
+        if row is None:
+            return None
+
+        return {
+            'id': row[0],
+            'user_id': row[1],
+            'last_used_at': row[2],
+            'data_items': [{'key': key, 'value': value} for key, value in simplejson.loads(row[3]).items()],
+            'revision': revision,
+        }
+
+    def create(self, session_json):
+        with self.connection:
+            # заодно удаляем истёкшие сессии; время в формате tools.time_format сравнимо как строка
+            self.connection.execute('DELETE FROM sessions WHERE last_used_at < ?',
+                                    (render_datetime(datetime.now() - SESSION_EXPIRES_AFTER),))
+            cursor = self.connection.execute('INSERT INTO sessions (user_id, last_used_at, data) VALUES (?, ?, ?)', (
+                session_json.get('user_id'),
+                session_json.get('last_used_at'),
+                self._dump_data(session_json.get('data_items', [])),
+            ))
+
+        session_json = dict(session_json, id=cursor.lastrowid, revision=None)
+        return session_json
+
+    def update(self, session_id, session_json):
+        columns = []
+        values = []
+        for name in ('user_id', 'last_used_at'):
+            if name in session_json:
+                columns.append(name)
+                values.append(session_json[name])
+        if 'data_items' in session_json:
+            columns.append('data')
+            values.append(self._dump_data(session_json['data_items']))
+
+        with self.connection:
+            cursor = self.connection.execute(
+                'UPDATE sessions SET %s WHERE id = ?' % ', '.join('%s = ?' % column for column in columns),
+                values + [session_id],
+            )
+
+        return '' if cursor.rowcount == 1 else None
+
+    @staticmethod
+    def _dump_data(data_items):
+        return simplejson.dumps({item['key']: item['value'] for item in data_items})
+
+
+SESSION_STORES = {
+    'remote': RemoteSessionStore,
+    'sqlite': LocalSessionStore,
+}
@@ -4,10 +4,33 @@ import os
 DEBUG_MODE = True
 PORT = 5000
 SESSION_EXPIRES_AFTER = timedelta(hours=1)
+# last_used_at неизменённой сессии обновляется не чаще, чем раз в SESSION_TOUCH_INTERVAL,
+# поэтому простаивающая сессия может истечь на столько же раньше SESSION_EXPIRES_AFTER
+SESSION_TOUCH_INTERVAL = timedelta(minutes=int(os.environ.get('SESSION_TOUCH_INTERVAL_MINUTES', 5)))
 
 FRONTEND_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# где хранить сессии: 'remote' - сервис сессий с кэшем в памяти воркера,
+# 'sqlite' - локальная база в SESSION_SQLITE_PATH (только если все воркеры на одной машине)
+SESSION_STORE = os.environ.get('SESSION_STORE', 'remote')
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_SIZE = 10000
+SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', os.path.join(FRONTEND_PATH, 'sessions.sqlite3'))
 STATIC_PATH = os.path.join(FRONTEND_PATH, 'static')
+TEMPLATES_PATH = os.path.join(FRONTEND_PATH, 'templates')
+TEMPLATES_BYTECODE_PATH = os.environ.get('TEMPLATES_BYTECODE_PATH', os.path.join(FRONTEND_PATH, 'build', 'jinja'))
+# копии статики с хэшем в имени и их сжатые версии (см. assets.py)
+STATIC_BUILD_PATH = os.environ.get('STATIC_BUILD_PATH', os.path.join(FRONTEND_PATH, 'build', 'static'))
+STATIC_FINGERPRINTS = os.environ.get('STATIC_FINGERPRINTS', '1') == '1'
+STATIC_CACHE_MAX_AGE = 365 * 24 * 60 * 60
 UPLOAD_FOLDER = os.path.join(STATIC_PATH, 'img')
+# загруженные фото профилей, под именами из хэша содержимого
+AVATARS_PATH = os.environ.get('AVATARS_PATH', os.path.join(FRONTEND_PATH, 'avatars'))
+AVATAR_MAX_SIZE = 2 * 1024 * 1024
+# размер миниатюр, в пикселях
+AVATAR_THUMBNAIL_SIZE = (300, 300)
+# сколько браузеры могут хранить фото, в секундах
+AVATAR_CACHE_MAX_AGE = 365 * 24 * 60 * 60
 
 
 #SERVICES_URI = {service: 'http://localhost:{}/api/{}'.format(port, service) for service, port in [
@@ -24,3 +47,76 @@ SERVICES_URI = {service: 'https://{}.herokuapp.com/api/{}'.format(domen, service
     ('rsoicourse-tasks', 'lessons'),
 ]}
 
+# все сервисы по одному адресу, например заглушки из benchmark.stubs: SERVICES_BASE_URI=http://localhost:5100/api
+if 'SERVICES_BASE_URI' in os.environ:
+    SERVICES_URI = {service: '{}/{}'.format(os.environ['SERVICES_BASE_URI'], service) for service in SERVICES_URI}
+
+# размеры пула keep-alive соединений к каждому сервису (на воркер)
+BACKEND_POOL_CONNECTIONS = int(os.environ.get('BACKEND_POOL_CONNECTIONS', 4))
+BACKEND_POOL_MAXSIZE = int(os.environ.get('BACKEND_POOL_MAXSIZE', 16))
+
+# таймауты (на соединение, на чтение ответа) запросов к сервисам, в секундах;
+# спящему dyno на heroku нужно несколько секунд, чтобы проснуться
+BACKEND_DEFAULT_TIMEOUT = (3.05, 15)
+BACKEND_TIMEOUTS = {
+    'sessions': (3.05, 5),
+}
+# сколько раз повторять GET при сетевой ошибке или ответе 502/503/504 и
+# какую долю от всех запросов к сервису могут составлять повторы
+BACKEND_GET_RETRIES = 2
+BACKEND_RETRY_BUDGET = 0.2
+# общее время всех попыток одного запроса к сервису, в секундах; меньше timeout
+# в gunicorn_config.py, чтобы воркер не убили посреди ожидания сервиса
+BACKEND_REQUEST_DEADLINE = float(os.environ.get('BACKEND_REQUEST_DEADLINE', 20))
+# после скольких сбоев подряд сервис считается недоступным и на сколько секунд
+BACKEND_BREAKER_THRESHOLD = 5
+BACKEND_BREAKER_COOLDOWN = 30
+# объединять одинаковые одновременные GET к сервису в один запрос и сколько секунд
+# ещё отдавать его результат следующим таким же запросам (0 - не отдавать)
+BACKEND_COALESCE_GETS = True
+BACKEND_COALESCE_TTL = float(os.environ.get('BACKEND_COALESCE_TTL', 0))
+
+# число потоков для параллельных запросов к сервисам (на воркер)
+BACKEND_FANOUT_WORKERS = int(os.environ.get('BACKEND_FANOUT_WORKERS', 8))
+# общий дедлайн на все параллельные запросы одной страницы, в секундах
+BACKEND_FANOUT_TIMEOUT = float(os.environ.get('BACKEND_FANOUT_TIMEOUT', 20))
+
+# сколько профилей запрашивать одним запросом (flask-restless отдаёт не более 100 на страницу)
+PROFILES_BATCH_SIZE = 50
+
+# список преподавателей кэшируется на TUTORS_CACHE_TTL секунд, после чего ещё
+# TUTORS_CACHE_STALE_TTL секунд отдаётся старый список, пока в фоне загружается новый
+TUTORS_CACHE_TTL = 300
+TUTORS_CACHE_STALE_TTL = 600
+
+# профили вошедших пользователей кэшируются на PROFILES_CACHE_TTL секунд
+PROFILES_CACHE_TTL = 60
+PROFILES_CACHE_SIZE = 10000
+
+# уроков на странице списка (flask-restless отдаёт не более 100 на страницу)
+LESSONS_PER_PAGE = 50
+# сколько уроков показывать в списке "требуют внимания"; недорешённые студентом ищутся
+# среди уроков с заданием от новых к старым страницами по LESSONS_SELECTED_PAGE_SIZE,
+# после первой - по LESSONS_SELECTED_BATCH страниц параллельно, но не дальше LESSONS_SELECTED_MAX_PAGES
+LESSONS_SELECTED_LIMIT = 20
+LESSONS_SELECTED_PAGE_SIZE = 50
+LESSONS_SELECTED_BATCH = 2
+LESSONS_SELECTED_MAX_PAGES = 6
+
+# отрисованные списки уроков и ответов, по версии данных
+FRAGMENTS_CACHE_TTL = 300
+FRAGMENTS_CACHE_SIZE = 1000
+
+# при недоступности сервисов страницы /me, /lessons и /lessons/<number> показываются
+# по последним удачно загруженным данным не старше LAST_KNOWN_GOOD_MAX_AGE секунд;
+# после сбоя LAST_KNOWN_GOOD_RETRY_AFTER секунд сервисы не ждём, а обновляем данные в фоне
+LAST_KNOWN_GOOD_SIZE = 2000
+LAST_KNOWN_GOOD_MAX_AGE = 3600
+LAST_KNOWN_GOOD_RETRY_AFTER = 10
+LAST_KNOWN_GOOD_REFRESH_WORKERS = 2
+
+# прогрев воркера gunicorn перед приёмом запросов (см. gunicorn_config.py): сколько
+# соединений открыть к каждому сервису и сколько ждать всех прогревочных запросов, в секундах
+WARM_UP = os.environ.get('WARM_UP', '1') == '1'
+WARM_UP_CONNECTIONS = int(os.environ.get('WARM_UP_CONNECTIONS', 2))
+WARM_UP_TIMEOUT = float(os.environ.get('WARM_UP_TIMEOUT', 10))
@@ -0,0 +1,152 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import pytest
+import requests
+
+from backend import CircuitBreaker, CircuitOpenError, RetryBudget, ServiceClient
+
+
+def test_breaker_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=3, cooldown=60)
+    for _ in range(2):
+        breaker.before_request('profiles')
+        breaker.record_failure()
+    assert not breaker.is_open
+
+    breaker.before_request('profiles')
+    breaker.record_failure()
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request('profiles')
+
+
+def test_breaker_success_resets_failures():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_breaker_lets_one_probe_through_after_cooldown():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    breaker.before_request('profiles')
+    # пока пробный запрос не завершён, остальные не пропускаются
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request('profiles')
+
+    breaker.record_success()
+    assert not breaker.is_open
+    breaker.before_request('profiles')
+
+
+def test_breaker_failed_probe_opens_again():
+    breaker = CircuitBreaker(threshold=5, cooldown=0.01)
+    for _ in range(5):
+        breaker.record_failure()
+    time.sleep(0.02)
+
+    breaker.before_request('profiles')
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request('profiles')
+
+
+def test_retry_budget_is_limited_by_ratio():
+    budget = RetryBudget(ratio=0.5, max_tokens=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_retry_budget_does_not_exceed_max_tokens():
+    budget = RetryBudget(ratio=1, max_tokens=2)
+    for _ in range(10):
+        budget.deposit()
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_unexpected_probe_error_reopens_breaker():
+    client = ServiceClient('profiles', 'http://profiles.invalid/api/profiles')
+    client.breaker = CircuitBreaker(threshold=1, cooldown=0.01)
+    client.breaker.record_failure()
+    time.sleep(0.02)
+
+    with mock.patch.object(requests.Session, 'request', side_effect=requests.exceptions.ChunkedEncodingError):
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            client.post()
+    assert not client.breaker.probing
+
+    # после следующего cooldown снова пропускается пробный запрос
+    time.sleep(0.02)
+    response = mock.Mock(status_code=200)
+    with mock.patch.object(requests.Session, 'request', return_value=response):
+        assert client.post() is response
+    assert not client.breaker.is_open
+
+
+def test_read_timeout_is_not_retried():
+    client = ServiceClient('profiles', 'http://profiles.invalid/api/profiles')
+    with mock.patch.object(requests.Session, 'request', side_effect=requests.exceptions.ReadTimeout) as request:
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            client.get(1)
+    assert request.call_count == 1
+
+
+def test_retries_fit_into_request_deadline():
+    client = ServiceClient('profiles', 'http://profiles.invalid/api/profiles')
+
+    def slow_failure(*args, **kwargs):
+        time.sleep(0.05)
+        raise requests.exceptions.ConnectionError
+
+    with mock.patch('backend.BACKEND_REQUEST_DEADLINE', 0.03), \
+            mock.patch.object(requests.Session, 'request', side_effect=slow_failure) as request:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.get(1)
+    assert request.call_count == 1
+    assert request.call_args[1]['timeout'][0] <= 0.03
+
+
+def test_connection_errors_are_retried():
+    client = ServiceClient('profiles', 'http://profiles.invalid/api/profiles')
+    response = mock.Mock(status_code=200)
+    with mock.patch.object(requests.Session, 'request',
+                           side_effect=[requests.exceptions.ConnectionError, response]) as request:
+        assert client.get(1) is response
+    assert request.call_count == 2
+
+
+
+def test_backend_cookies_are_not_kept():
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'backend=secret; Path=/')
+            self.send_header('X-Received-Cookie', self.headers.get('Cookie', ''))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = ServiceClient('profiles', 'http://127.0.0.1:%d/api/profiles' % server.server_port)
+        client.get(1)
+        assert client.get(2).headers['X-Received-Cookie'] == ''
+    finally:
+        server.shutdown()
@@ -19,3 +19,9 @@ def parse_datetime(datetime_string):
     if datetime_string is None:
         return None
     return datetime.strptime(datetime_string, time_format)
+
+
+def make_version(*parts):
+    from hashlib import sha1
+
+    return sha1(repr(parts).encode('UTF-8')).hexdigest()